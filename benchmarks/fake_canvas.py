@@ -0,0 +1,247 @@
+import hashlib
+import io
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import py7zr
+
+
+C_SOURCE = ('#include <stdio.h>\n\nint main(void)\n{{\n    int total = 0;\n    for (int i = 0; i < {limit}; i++) {{\n'
+            '        total += i * {scale};\n    }}\n    printf("%d\\n", total);\n    return 0;\n}}\n')
+
+# Submission formats, picked at random per submission
+ARCHIVE_KINDS = ['zip', 'nested', '7z', 'utf16', 'plain']
+
+
+class FakeCourse:
+    """
+    Synthetic Canvas data for one course, split into lab sections with one TA each.
+    Every submission has one attachment, drawn from a pool of variants per archive kind so that
+    thousands of students do not mean thousands of 7z compressions at startup.
+    """
+
+    def __init__(self, sections: int = 2, students: int = 10, assignments: int = 3, attachment_kb: int = 4,
+                 kinds: list = None, variants: int = 64, latency: float = 0.0, seed: int = 0) -> None:
+        rng = random.Random(seed)
+        kinds = kinds or ARCHIVE_KINDS
+        self.latency = latency
+        self.courses = list()
+        self.users = dict()
+        self.assignments = dict()
+        self.submissions = dict()
+        self.files = dict()
+        self.enrollments = dict()
+
+        # Attachment payloads, shared between submissions
+        payloads = {kind: [self._archive(kind, rng, attachment_kb) for _ in range(variants)] for kind in kinds}
+
+        uid = 1000
+        fid = 1
+        for s in range(sections):
+            cid = 100 + s
+            self.courses.append({'id': cid, 'name': 'LAB_%02d - Fall 2023' % s, 'course_code': 'CPTS_121',
+                                 'enrollment_term_id': 5})
+
+            # Students of the section, then its TA
+            roster = list()
+            for _ in range(students):
+                uid += 1
+                roster.append({'id': uid, 'name': 'Student %d' % uid, 'sis_user_id': str(uid),
+                               'login_id': 'stu%d' % uid})
+            uid += 1
+            ta = {'id': uid, 'name': 'TA %d' % s, 'sis_user_id': str(uid), 'login_id': 'ta%d' % uid}
+            self.users[cid] = {'student': roster, 'ta': [ta]}
+            self.enrollments[cid] = [{'type': 'TaEnrollment', 'user_id': ta['id'], 'user': {'name': ta['name']},
+                                      'total_activity_time': 1000}] + \
+                [{'type': 'StudentEnrollment', 'user_id': st['id'], 'user': {'name': st['name']},
+                  'total_activity_time': 10, 'grades': {'current_score': 90.0, 'final_score': 80.0}}
+                 for st in roster]
+
+            self.assignments[cid] = [{'id': 10 * (a + 1), 'name': 'PA%d' % (a + 1), 'course_id': cid}
+                                     for a in range(assignments)]
+            for assignment in self.assignments[cid]:
+                subs = list()
+                for st in roster:
+                    payload, filename = rng.choice(payloads[rng.choice(kinds)])
+                    self.files[fid] = payload
+                    subs.append({'id': fid, 'user_id': st['id'], 'assignment_id': assignment['id'],
+                                 'score': float(rng.randrange(0, 100)) if rng.random() < .8 else None,
+                                 'seconds_late': rng.choice([0, 0, 0, 86400 * 10, 86400 * 40]),
+                                 'graded_at': '2023-10-01T00:00:00Z', 'submitted_at': '2023-09-30T00:00:00Z',
+                                 'attachments': [{'id': fid, 'filename': filename, 'size': len(payload),
+                                                  'updated_at': '2023-09-30T00:00:00Z',
+                                                  'url': 'FILES/%d/download' % fid}]})
+                    fid += 1
+                self.submissions[(cid, assignment['id'])] = subs
+        return
+
+    # Builds one attachment of the given kind, source plus attachment_kb of build output to skip
+    @staticmethod
+    def _archive(kind: str, rng: random.Random, attachment_kb: int) -> tuple:
+        source = C_SOURCE.format(limit=rng.randrange(10, 1000), scale=rng.randrange(1, 9)).encode()
+        padding = rng.randbytes(attachment_kb * 1024)
+        if kind == 'plain':
+            return source, 'main.c'
+        if kind == 'utf16':
+            return source.decode().encode('utf-16'), 'main.c'
+
+        buf = io.BytesIO()
+        if kind == '7z':
+            with py7zr.SevenZipFile(buf, 'w') as z:
+                z.writestr(source, 'src/main.c')
+                z.writestr(padding, 'build/a.out')
+            return buf.getvalue(), 'submission.7z'
+
+        with zipfile.ZipFile(buf, 'w') as z:
+            z.writestr('src/main.c', source)
+            z.writestr('build/a.out', padding)
+            if kind == 'nested':
+                inner = io.BytesIO()
+                with zipfile.ZipFile(inner, 'w') as zi:
+                    zi.writestr('helper.cpp', source.replace(b'main', b'helper'))
+                    zi.writestr('notes.txt', b'nothing to see here\n')
+                z.writestr('extra.zip', inner.getvalue())
+        return buf.getvalue(), 'submission.zip'
+
+
+class CanvasHandler(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the Canvas REST API the tool uses, with Link pagination and ETags.
+    """
+    course = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args) -> None:
+        return
+
+    def _send(self, body, content_type: str = 'application/json', headers: dict = None) -> None:
+        if self.course.latency:
+            time.sleep(self.course.latency)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def _paginate(self, items: list, query: dict, path: str) -> None:
+        per_page = int(query.get('per_page', ['10'])[-1])
+        page = int(query.get('page', ['1'])[0])
+        chunk = items[(page - 1) * per_page:page * per_page]
+
+        headers = dict()
+        if page * per_page < len(items):
+            next_query = dict(query, page=[str(page + 1)], per_page=[str(per_page)])
+            url = 'http://%s%s?%s' % (self.headers['Host'], path, urllib.parse.urlencode(next_query, doseq=True))
+            headers['Link'] = '<%s>; rel="next"' % url
+        self._send(chunk, headers=headers)
+        return
+
+    def do_GET(self) -> None:
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        path = parsed.path
+        course = self.course
+        host = 'http://%s' % self.headers['Host']
+
+        match = re.fullmatch(r'/files/(\d+)/download', path)
+        if match:
+            return self._send(course.files[int(match.group(1))], 'application/octet-stream')
+
+        path_api = path[len('/api/v1'):]
+        if path_api == '/users/self':
+            return self._send({'id': 1, 'name': 'Head TA'})
+        if path_api == '/courses':
+            return self._paginate(course.courses, query, path)
+
+        match = re.fullmatch(r'/courses/(\d+)', path_api)
+        if match:
+            return self._send(next(c for c in course.courses if c['id'] == int(match.group(1))))
+        match = re.fullmatch(r'/courses/(\d+)/(?:search_)?users', path_api)
+        if match:
+            return self._paginate(course.users[int(match.group(1))][query['enrollment_type[]'][0]], query, path)
+        match = re.fullmatch(r'/courses/(\d+)/assignments', path_api)
+        if match:
+            return self._paginate(course.assignments[int(match.group(1))], query, path)
+        match = re.fullmatch(r'/courses/(\d+)/assignments/(\d+)/submissions', path_api)
+        if match:
+            subs = course.submissions[(int(match.group(1)), int(match.group(2)))]
+            return self._paginate(self._with_host(subs, host), query, path)
+        match = re.fullmatch(r'/courses/(\d+)/students/submissions', path_api)
+        if match:
+            cid = int(match.group(1))
+            subs = [s for a in course.assignments[cid] for s in course.submissions[(cid, a['id'])]]
+            since = query.get('graded_since', query.get('submitted_since', [None]))[0]
+            if since is not None:
+                subs = [s for s in subs if s['graded_at'] > since]
+            return self._paginate(self._with_host(subs, host), query, path)
+        match = re.fullmatch(r'/courses/(\d+)/sections', path_api)
+        if match:
+            cid = int(match.group(1))
+            return self._paginate([{'id': cid * 10, 'name': 'sec', 'course_id': cid}], query, path)
+        match = re.fullmatch(r'/sections/(\d+)/enrollments', path_api)
+        if match:
+            return self._paginate(course.enrollments[int(match.group(1)) // 10], query, path)
+
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+
+    # Attachment urls point back at this server
+    @staticmethod
+    def _with_host(subs: list, host: str) -> list:
+        return [dict(s, attachments=[dict(a, url=a['url'].replace('FILES', host + '/files'))
+                                     for a in s['attachments']]) for s in subs]
+
+
+def serve(course: FakeCourse, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serves course on a background thread of this process.
+    """
+    handler = type('BoundHandler', (CanvasHandler,), {'course': course})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _serve_forever(course_kwargs: dict, ports) -> None:
+    server = serve(FakeCourse(**course_kwargs))
+    ports.put(server.server_address[1])
+    threading.Event().wait()
+    return
+
+
+def start_server(**course_kwargs) -> tuple:
+    """
+    Builds and serves a FakeCourse in its own process, so the server never competes with the code
+    being measured for the GIL. Returns the process and the Canvas url.
+    """
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    process = context.Process(target=_serve_forever, args=(course_kwargs, ports), daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:%d' % ports.get(timeout=600)
@@ -0,0 +1,152 @@
+import multiprocessing
+import pathlib
+import random
+import re
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Match pages are framesets, as on moss.stanford.edu
+MATCH_PAGE = ('<HTML><FRAMESET ROWS="150,*"><FRAME SRC="match{0}-top.html" NAME="top"><FRAMESET COLS="50%,50%">'
+              '<FRAME SRC="match{0}-0.html"><FRAME SRC="match{0}-1.html"></FRAMESET></FRAMESET></HTML>')
+
+FRAME_PAGE = '<HTML><PRE>' + 'int main() { return 0; }\n' * 200 + '</PRE></HTML>'
+
+
+class FakeMoss:
+    """
+    Reports of the submissions received so far, each pairs up random submitted directories.
+    """
+
+    def __init__(self, matches: int = 250, latency: float = 0.0, seed: int = 0) -> None:
+        self.matches = matches
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.reports = dict()
+        self.lock = threading.Lock()
+        return
+
+    def add_report(self, names: list) -> int:
+        # MOSS lists the directory of each matched file
+        directories = sorted({str(pathlib.PurePosixPath(name).parent) for name in names})
+        with self.lock:
+            report_id = len(self.reports) + 1
+            pairs = list()
+            for _ in range(min(self.matches, len(directories) * (len(directories) - 1) // 2)):
+                first, second = self.rng.sample(directories, 2)
+                pairs.append((first, second, self.rng.randint(0, 99), self.rng.randint(0, 99),
+                              self.rng.randint(1, 500)))
+            self.reports[report_id] = pairs
+        return report_id
+
+    def report_html(self, base: str, report_id: int) -> str:
+        rows = list()
+        for number, (first, second, percent_1, percent_2, lines) in enumerate(self.reports[report_id]):
+            url = '{}/match{}.html'.format(base, number)
+            rows.append('<TR><TD><A HREF="{0}">{1}/ ({2}%)</A>\n    <TD><A HREF="{0}">{3}/ ({4}%)</A>\n'
+                        '<TD ALIGN=right>{5}\n'.format(url, first, percent_1, second, percent_2, lines))
+        return ('<HTML><BODY>Moss Results<p><HR>\n<TABLE>\n<TR><TH>File 1<TH>File 2<TH>Lines Matched\n'
+                '{}</TABLE></BODY></HTML>\n'.format(''.join(rows)))
+
+
+class MossSubmitHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks the submitting side of the MOSS protocol, answers each query with a results url.
+    """
+    moss = None
+    web_port = None
+
+    def handle(self) -> None:
+        names = list()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            words = line.decode().split()
+            if words[0] == 'language':
+                self.wfile.write(b'yes\n')
+            elif words[0] == 'file':
+                self.rfile.read(int(words[3]))
+                names.append(words[4])
+            elif words[0] == 'query':
+                report_id = self.moss.add_report(names)
+                self.wfile.write('http://127.0.0.1:{}/results/{}\n'.format(self.web_port, report_id).encode())
+            elif words[0] == 'end':
+                return
+
+
+class MossWebHandler(BaseHTTPRequestHandler):
+    """
+    Serves results pages, match pages and their frames.
+    """
+    moss = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args) -> None:
+        return
+
+    def do_GET(self) -> None:
+        if self.moss.latency:
+            time.sleep(self.moss.latency)
+
+        body = None
+        match = re.fullmatch(r'/results/(\d+)', self.path)
+        if match and int(match.group(1)) in self.moss.reports:
+            base = 'http://{}{}'.format(self.headers['Host'], self.path)
+            body = self.moss.report_html(base, int(match.group(1)))
+        match = re.fullmatch(r'/results/\d+/match(\d+)\.html', self.path)
+        if match:
+            body = MATCH_PAGE.format(match.group(1))
+        if re.fullmatch(r'/results/\d+/match\d+-(top|0|1)\.html', self.path):
+            body = FRAME_PAGE
+
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return
+
+
+def serve(moss: FakeMoss) -> tuple:
+    """
+    Serves moss on background threads of this process, returns the submission and web servers.
+    """
+    web_server = ThreadingHTTPServer(('127.0.0.1', 0), type('BoundWebHandler', (MossWebHandler,), {'moss': moss}))
+    submit_handler = type('BoundSubmitHandler', (MossSubmitHandler,),
+                          {'moss': moss, 'web_port': web_server.server_address[1]})
+    submit_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), submit_handler)
+    submit_server.daemon_threads = True
+
+    for server in [submit_server, web_server]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return submit_server, web_server
+
+
+def _serve_forever(moss_kwargs: dict, ports) -> None:
+    submit_server, _ = serve(FakeMoss(**moss_kwargs))
+    ports.put(submit_server.server_address[1])
+    threading.Event().wait()
+    return
+
+
+def start_server(**moss_kwargs) -> tuple:
+    """
+    Serves a FakeMoss in its own process, returns the process and the port to submit to.
+    """
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    process = context.Process(target=_serve_forever, args=(moss_kwargs, ports), daemon=True)
+    process.start()
+    return process, ports.get(timeout=60)
@@ -0,0 +1,245 @@
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import fake_canvas
+import fake_moss
+
+from util.api import API
+from util.extract import process_submission
+from util.moss import run_moss
+from util.process import process_moss
+
+
+STAGES = ['gradebook', 'gradebook_warm', 'gradebook_bulk', 'gradebook_per_assignment', 'download_submissions',
+          'process_submission', 'run_moss', 'process_moss', 'process_moss_local']
+
+# Submissions extracted one by one in the process_submission stage
+EXTRACT_SAMPLE = 500
+
+
+class Stage:
+    """
+    Times a block, wall clock and this process's cpu, with the canvas round trips it made.
+    """
+
+    def __init__(self, api: API = None) -> None:
+        self.api = api
+        self.result = dict()
+        return
+
+    def __enter__(self) -> 'Stage':
+        self.round_trips = self.api.request_counter.total if self.api is not None else 0
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.result['seconds'] = round(time.perf_counter() - self.wall, 4)
+        self.result['cpu_seconds'] = round(time.process_time() - self.cpu, 4)
+        if self.api is not None:
+            self.result['round_trips'] = self.api.request_counter.total - self.round_trips
+        return
+
+
+@contextlib.contextmanager
+def quiet_output():
+    """
+    Silences stdout at the descriptor, so the spawned extraction and render workers are quiet too.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def time_extraction(work_dir: pathlib.Path, kinds: list, sample: int, attachment_kb: int) -> dict:
+    """
+    Extracts sample submissions serially, laid out the way the download stage leaves them.
+    """
+    rng = random.Random(1)
+    assignment_dir = work_dir / 'extract'
+    assignment_dir.mkdir()
+
+    jobs = list()
+    for number in range(sample):
+        payload, filename = fake_canvas.FakeCourse._archive(rng.choice(kinds), rng, attachment_kb)
+        student_dir = assignment_dir / 'Student_{}'.format(number)
+        suffix = pathlib.Path(filename).suffix
+        if suffix in ('.zip', '.7z'):
+            student_dir.with_suffix(suffix).write_bytes(payload)
+        else:
+            student_dir.mkdir()
+            (student_dir / filename).write_bytes(payload)
+        jobs.append((student_dir, suffix == '.zip', suffix == '.7z'))
+
+    totals = {'submissions': sample, 'kept': 0, 'skipped': 0, 'bytes_extracted': 0}
+    with Stage() as stage:
+        for student_dir, zip_type, zip7_type in jobs:
+            stats = process_submission(student_dir, zip_type=zip_type, zip7_type=zip7_type)
+            for key in ['kept', 'skipped', 'bytes_extracted']:
+                totals[key] += stats[key]
+    totals.update(stage.result)
+    totals['per_submission_ms'] = round(1000 * stage.result['seconds'] / max(sample, 1), 3)
+    return totals
+
+
+def open_course(canvas_url: str, work_dir: pathlib.Path, cache_dir: pathlib.Path = None) -> API:
+    """
+    Connects to the fake canvas and selects its course, stored under work_dir/terms.
+    Requests go through the response cache when cache_dir is given.
+    """
+    api = API(canvas_url, 'benchmark')
+    if cache_dir is not None:
+        api.enable_response_cache(cache_dir)
+    _, courses = api.get_latest_courses()
+    course_name = next(iter(courses))
+    api.set_current_course(course_name, courses[course_name])
+    api.set_course_dir(work_dir / 'terms' / course_name)
+    api.course_dir.mkdir(parents=True, exist_ok=True)
+    return api
+
+
+def run_scale(students: int, args: argparse.Namespace) -> dict:
+    """
+    Runs every stage against a fresh fake course of the given size, returns each stage's timings.
+    """
+    sections = max(students // args.section_size, 1)
+    course_kwargs = {'sections': sections, 'students': max(students // sections, 1),
+                     'assignments': args.assignments, 'attachment_kb': args.attachment_kb, 'kinds': args.kinds,
+                     'latency': args.latency}
+    canvas_process, canvas_url = fake_canvas.start_server(**course_kwargs)
+    moss_process, moss_port = fake_moss.start_server(latency=args.latency)
+
+    work_dir = pathlib.Path(tempfile.mkdtemp(prefix='bench-'))
+    stages = dict()
+    try:
+        api = open_course(canvas_url, work_dir, work_dir / '.http_cache')
+        course_dir = api.course_dir
+        assignments = api.get_assignments()
+
+        # Stage output is the tool's own progress printing, kept out of the report unless asked for
+        with contextlib.nullcontext() if args.verbose else quiet_output():
+            with Stage(api) as stage:
+                api.download_information()
+            stages['gradebook'] = stage.result
+
+            with Stage(api) as stage:
+                api.download_information()
+            stages['gradebook_warm'] = stage.result
+
+            # Bulk fetching against the per assignment path it replaced, each on its own uncached connection
+            # so both round trip counts include every roster, grader and submission request
+            for name, bulk_submissions in [('gradebook_bulk', True), ('gradebook_per_assignment', False)]:
+                fresh_api = open_course(canvas_url, work_dir)
+                with Stage(fresh_api) as stage:
+                    fresh_api.download_information(bulk_submissions=bulk_submissions, incremental=False)
+                stages[name] = stage.result
+
+            with Stage(api) as stage:
+                api.download_information(download_student_code=True, assignments_list=assignments)
+            stages['download_submissions'] = stage.result
+
+            stages['process_submission'] = time_extraction(work_dir, args.kinds or fake_canvas.ARCHIVE_KINDS,
+                                                           min(students, EXTRACT_SAMPLE), args.attachment_kb)
+
+            with Stage() as stage:
+                jobs = run_moss(course_dir, assignments, port=moss_port, host='127.0.0.1', user_id='1')
+            stages['run_moss'] = dict(stage.result, failed=sum(job.status == 'failed' for job in jobs.values()))
+
+            with Stage() as stage:
+                process_moss(course_dir, preview=not args.full_resolution)
+            stages['process_moss'] = stage.result
+
+            with Stage() as stage:
+                process_moss(course_dir, engine='local', preview=not args.full_resolution)
+            stages['process_moss_local'] = stage.result
+    finally:
+        canvas_process.terminate()
+        moss_process.terminate()
+        if args.keep:
+            print('Kept work directory', work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'students': sections * course_kwargs['students'], 'sections': sections, 'stages': stages}
+
+
+def compare(runs: list, baseline_path: pathlib.Path, tolerance: float) -> list:
+    """
+    Lists the stages that got slower than the baseline report by more than tolerance.
+    """
+    baseline = {run['students']: run['stages'] for run in json.loads(baseline_path.read_text())['runs']}
+    regressions = list()
+    for run in runs:
+        for name, result in run['stages'].items():
+            before = baseline.get(run['students'], dict()).get(name)
+            if before is None or before['seconds'] <= 0:
+                continue
+            ratio = result['seconds'] / before['seconds']
+            if ratio > 1 + tolerance:
+                regressions.append('{} students, {}: {:.2f}s -> {:.2f}s ({:.0%} slower)'.format(
+                    run['students'], name, before['seconds'], result['seconds'], ratio - 1))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Time each pipeline stage against local fake Canvas and MOSS '
+                                                 'servers, at several course sizes')
+    parser.add_argument('--scales', default='50,500', help='comma separated student counts, e.g. 50,500,5000')
+    parser.add_argument('--section-size', type=int, default=25, help='students per lab section')
+    parser.add_argument('--assignments', type=int, default=3)
+    parser.add_argument('--attachment-kb', type=int, default=4, help='build output padding per archive')
+    parser.add_argument('--kinds', help='comma separated archive kinds, any of: ' + ', '.join(fake_canvas.ARCHIVE_KINDS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake server response')
+    parser.add_argument('--full-resolution', action='store_true', help='render plots at full resolution')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the json report')
+    parser.add_argument('--baseline', help='earlier json report, exit 1 if a stage got slower than it')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the work directories')
+    parser.add_argument('--verbose', action='store_true', help='show the output of each stage')
+    args = parser.parse_args()
+    args.kinds = args.kinds.split(',') if args.kinds else None
+
+    runs = list()
+    for students in [int(scale) for scale in args.scales.split(',')]:
+        print('Running {} students...'.format(students))
+        runs.append(run_scale(students, args))
+        for name in STAGES:
+            result = runs[-1]['stages'][name]
+            print('    {:<24}{:>10.2f} s{:>10.2f} cpu s{:>8}'.format(name, result['seconds'], result['cpu_seconds'],
+                                                                     result.get('round_trips', '')))
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'latency': args.latency,
+              'assignments': args.assignments, 'attachment_kb': args.attachment_kb,
+              'kinds': args.kinds or fake_canvas.ARCHIVE_KINDS, 'runs': runs}
+    pathlib.Path(args.output).write_text(json.dumps(report, indent=2))
+    print('Wrote', args.output)
+
+    if args.baseline is not None:
+        regressions = compare(runs, pathlib.Path(args.baseline), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import pathlib
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from util.moss_report import RESULT_COLUMNS
+from util.process import score_pairs
+
+
+# Builds get_results output shaped like a term of MOSS reports
+def synthetic_results(assignments: int, pairs: int, students: int = 600) -> dict:
+    rng = np.random.default_rng(0)
+    results = dict()
+    for a in range(assignments):
+        assignment = 'PA{}'.format(a)
+        first = rng.integers(0, students, pairs)
+        second = rng.integers(0, students, pairs)
+        results[assignment] = pd.DataFrame({
+            'PA': assignment,
+            'TA 1': ['TA_{}'.format(s % 14) for s in first], 'TA 2': ['TA_{}'.format(s % 14) for s in second],
+            'student 1': ['Student_{}'.format(s) for s in first], 'student 2': ['Student_{}'.format(s) for s in second],
+            'percent_1': rng.integers(0, 100, pairs), 'percent_2': rng.integers(0, 100, pairs),
+            'lines_matched': rng.integers(1, 500, pairs),
+            'url': ['http://moss.stanford.edu/results/1/{}/match{}.html'.format(a, p) for p in range(pairs)]
+        }, columns=RESULT_COLUMNS)
+    return results
+
+
+# The row by row scoring save_to_csv used before it was vectorized, without the excel write
+def legacy_score_pairs(results: dict) -> tuple:
+    students = dict()
+    for assignment in sorted(results.keys()):
+        mean = results[assignment][['percent_1', 'percent_2']].max(axis=1).mean()
+        std = results[assignment][['percent_1', 'percent_2']].max(axis=1).std()
+
+        for index, row in results[assignment].iterrows():
+            val_1 = (mean - row['percent_1']) / std
+            if row['student 1'] not in students:
+                students[row['student 1']] = val_1
+            else:
+                students[row['student 1']] += val_1
+
+            val_2 = (mean - row['percent_2']) / std
+            if row['student 2'] not in students:
+                students[row['student 2']] = val_2
+            else:
+                students[row['student 2']] += val_2
+
+    vals = sorted(students.values())
+    std = statistics.pstdev(vals)
+    mean = statistics.mean(vals)
+    for key in students:
+        students[key] = (students[key] - mean) / std
+
+    all_data = None
+    for assignment in sorted(results.keys()):
+        results[assignment]['percent_same'] = results[assignment][["percent_1", "percent_2"]].max(axis=1)
+        results[assignment]['TA Confidence (1-5)'] = ''
+        results[assignment]['HEAD TA Confidence (1-5)'] = ''
+
+        p_mean = results[assignment][['percent_1', 'percent_2']].max(axis=1).mean()
+        p_std = results[assignment][['percent_1', 'percent_2']].max(axis=1).std()
+        results[assignment] = results[assignment][(results[assignment]['percent_1'] > p_mean + 1 * p_std) |
+                                                  (results[assignment]['percent_2'] > p_mean + 1 * p_std) |
+                                                  (results[assignment]['percent_1'] > 80) |
+                                                  (results[assignment]['percent_2'] > 80) |
+                                                  (results[assignment].index < 20)]
+        if all_data is None:
+            all_data = results[assignment]
+        else:
+            all_data = pd.concat([all_data, results[assignment]])
+
+    return all_data, students
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the row by row and vectorized save_to_csv scoring')
+    parser.add_argument('--assignments', type=int, default=12)
+    parser.add_argument('--pairs', type=int, default=2500)
+    args = parser.parse_args()
+
+    results = synthetic_results(args.assignments, args.pairs)
+
+    start = time.perf_counter()
+    legacy_rows, legacy_scores = legacy_score_pairs({key: frame.copy() for key, frame in results.items()})
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows, scores = score_pairs(results)
+    vectorized = time.perf_counter() - start
+
+    # Same spreadsheet rows and the same student scores
+    pd.testing.assert_frame_equal(rows, legacy_rows)
+    pd.testing.assert_series_equal(scores.sort_index(), pd.Series(legacy_scores).sort_index(), check_names=False)
+
+    print('{} assignments x {} pairs, {} rows kept'.format(args.assignments, args.pairs, len(rows)))
+    print('{:<12}{:>12}'.format('scoring', 'seconds'))
+    print('{:<12}{:>12.4f}'.format('legacy', legacy))
+    print('{:<12}{:>12.4f}'.format('vectorized', vectorized))
+    print('speedup {:.0f}x'.format(legacy / vectorized))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import pathlib
+import re
+import subprocess
+import sys
+
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+# Import budgets in milliseconds, generous enough for a slow lab machine
+BUDGETS = {'main': 150, 'cli': 1500}
+
+# Modules that must stay out of the gui's startup path, they load with the action that needs them
+DEFERRED = ['pandas', 'numpy', 'canvasapi', 'matplotlib', 'seaborn', 'networkx']
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def measure_imports(module: str) -> list:
+    """
+    Imports module in a fresh interpreter under -X importtime, returns (name, self us, cumulative us, depth).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr))
+
+    imports = list()
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is not None:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return imports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Check entry point import times against their budgets')
+    parser.add_argument('modules', nargs='*', default=sorted(BUDGETS), help='entry points to measure')
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many cold imports')
+    parser.add_argument('--top', type=int, default=5, help='slowest imports to list')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        runs = [measure_imports(module) for _ in range(args.repeat)]
+        best = min(runs, key=lambda imports: sum(cumulative for _, _, cumulative, depth in imports if depth == 0))
+        total = sum(cumulative for _, _, cumulative, depth in best if depth == 0) / 1000
+        budget = BUDGETS.get(module)
+
+        status = 'ok'
+        if budget is not None and total > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print('{:<8}{:>10.1f} ms  budget {:>6} ms  {}'.format(module, total, budget or '-', status))
+
+        # Name the heaviest top level imports, so a regression points at its cause
+        for name, _, cumulative, depth in sorted(best, key=lambda item: -item[2])[:args.top]:
+            print('    {:<40}{:>10.1f} ms'.format(name, cumulative / 1000))
+
+        if module == 'main':
+            loaded = {name for name, _, _, _ in best}
+            eager = [name for name in DEFERRED if name in loaded]
+            if eager:
+                print('    imported at startup but should be deferred: ' + ', '.join(eager))
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
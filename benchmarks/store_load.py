@@ -0,0 +1,69 @@
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from util.store import save_frame, STORE_DIR
+
+
+# Builds a gradebook shaped like the one API.download_information saves
+def synthetic_grade_book(students: int, assignments: int, sections: int = 14) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    data = {'Name': ['Student {}'.format(i) for i in range(students)],
+            'ID': np.arange(students),
+            'SIS User ID': [str(i) for i in range(students)],
+            'SIS Login ID': ['student{}'.format(i) for i in range(students)],
+            'Section': ['LAB_{:02d}'.format(i % sections) for i in range(students)],
+            'Type': 'student'}
+    for a in range(assignments):
+        data['PA{}'.format(a)] = np.where(rng.random(students) < .2, np.nan, rng.integers(0, 100, students))
+        data['PA{}-Late'.format(a)] = rng.choice([0, 0, 0, 86400 * 9, 86400 * 30], students)
+    data['current_score'] = rng.random(students) * 100
+    data['final_score'] = rng.random(students) * 100
+    return pd.DataFrame(data)
+
+
+def time_load(course_dir: pathlib.Path, name: str, repeat: int) -> tuple:
+    excel = min(_time(lambda: pd.read_excel(course_dir / (name + '.xlsx'))) for _ in range(repeat))
+    feather = min(_time(lambda: pd.read_feather(course_dir / STORE_DIR / (name + '.feather'))) for _ in range(repeat))
+    return excel, feather
+
+
+def _time(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare Excel and Feather load times for course frames')
+    parser.add_argument('course_dir', nargs='?', help='course directory, a synthetic one is built if omitted')
+    parser.add_argument('--students', type=int, default=600)
+    parser.add_argument('--assignments', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.course_dir is None:
+            course_dir = pathlib.Path(tmp)
+            save_frame(course_dir, 'grade_book_late', synthetic_grade_book(args.students, args.assignments))
+            names = ['grade_book_late']
+        else:
+            course_dir = pathlib.Path(args.course_dir)
+            names = ['grade_book', 'grade_book_late', 'ta_list']
+
+        print('{:<20}{:>12}{:>12}{:>10}'.format('frame', 'excel (s)', 'feather (s)', 'speedup'))
+        for name in names:
+            excel, feather = time_load(course_dir, name, args.repeat)
+            print('{:<20}{:>12.4f}{:>12.4f}{:>9.0f}x'.format(name, excel, feather, excel / feather))
+    return
+
+
+if __name__ == '__main__':
+    main()
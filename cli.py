@@ -0,0 +1,180 @@
+import argparse
+import configparser
+import os
+import pathlib
+import sys
+import traceback
+
+from canvasapi.exceptions import CanvasException
+from requests.exceptions import RequestException
+
+from util.api import API
+from util.metrics import get_metrics, write_run_report
+
+
+# Exit codes, 2 is also what argparse uses for bad arguments
+EXIT_OK = 0
+EXIT_ACTION_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CANVAS = 3
+EXIT_NO_COURSE = 4
+
+# Actions in the order they are usually run, same names as the gui's
+ACTIONS = ['create_gradebook', 'download_submissions', 'run_moss', 'generate_cheating_spreadsheet',
+           'generate_cheating_spreadsheet_offline', 'check_prior_terms', 'grading_status', 'late_status']
+
+TOKEN_ENV = 'CANVAS_TOKEN'
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Run Canvas Lab Manager actions without the gui. '
+                                                 'The canvas token is read from ${}.'.format(TOKEN_ENV))
+    parser.add_argument('--config', default='user_settings.ini',
+                        help='ini file whose [settings] section gives defaults for url, course, actions, '
+                             'assignments and plot_resolution')
+    parser.add_argument('--url', help='canvas url')
+    parser.add_argument('--course', help='course code, as listed for the latest term')
+    parser.add_argument('--actions', help='comma separated, any of: ' + ', '.join(ACTIONS))
+    parser.add_argument('--assignments', help='comma separated assignment names, default all')
+    parser.add_argument('--language', default='cc', help='moss language')
+    parser.add_argument('--full-gradebook', action='store_true',
+                        help='refetch every section gradebook instead of syncing changes, e.g. for a nightly job')
+    parser.add_argument('--per-assignment-gradebook', action='store_true',
+                        help='fetch gradebooks one assignment at a time instead of from the bulk submissions listing, '
+                             'to compare round trips')
+    parser.add_argument('--force-moss', action='store_true', help='resubmit unchanged assignments to moss')
+    parser.add_argument('--full-resolution', action='store_true', help='render plots at full resolution')
+    parser.add_argument('--list-courses', action='store_true', help='print the latest term\'s courses and exit')
+    args = parser.parse_args(argv)
+
+    # Fill in anything not given on the command line from the config file
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    settings = config['settings'] if config.has_section('settings') else dict()
+    for key in ['url', 'course', 'actions', 'assignments']:
+        if getattr(args, key) is None:
+            setattr(args, key, settings.get(key))
+    if not args.full_resolution:
+        args.full_resolution = settings.get('plot_resolution', 'preview') == 'full'
+
+    args.actions = split_list(args.actions)
+    args.assignments = split_list(args.assignments)
+    return args
+
+
+def split_list(value: str) -> list:
+    if value is None or value.strip() in ('', 'all'):
+        return None
+    return [item.strip() for item in value.split(',') if item.strip() != '']
+
+
+def run_action(action: str, api: API, course_dir: pathlib.Path, args: argparse.Namespace) -> bool:
+    """
+    Runs one action the way the gui would, returns False when it did not fully succeed.
+    """
+    preview = not args.full_resolution
+
+    if action == 'create_gradebook':
+        api.download_information(incremental=not args.full_gradebook,
+                                 bulk_submissions=not args.per_assignment_gradebook)
+    elif action == 'download_submissions':
+        assignments = args.assignments or api.get_assignments()
+        # Students failing is not fatal to the download, but it is to a batch run
+        failed = api.download_information(download_student_code=True, assignments_list=assignments,
+                                          incremental=not args.full_gradebook,
+                                          bulk_submissions=not args.per_assignment_gradebook)
+        return failed == 0
+    elif action == 'run_moss':
+        from util.moss import run_moss
+        assignments = args.assignments or sorted(path.name for path in (course_dir / 'assignments').iterdir())
+        jobs = run_moss(course_dir, assignments, args.language, force=args.force_moss)
+        return all(job.status != 'failed' for job in jobs.values())
+    elif action == 'generate_cheating_spreadsheet':
+        from util.process import process_moss
+        process_moss(course_dir, preview=preview)
+    elif action == 'generate_cheating_spreadsheet_offline':
+        from util.process import process_moss
+        process_moss(course_dir, engine='local', preview=preview)
+    elif action == 'check_prior_terms':
+        from util.fingerprints import check_prior_terms
+        check_prior_terms(course_dir, api.term_name, args.assignments)
+    elif action == 'grading_status':
+        from util.plot_grade import plot_grade
+        plot_grade(course_dir, args.assignments or api.get_assignments(), preview=preview)
+    elif action == 'late_status':
+        from util.plot_late import plot_late
+        plot_late(course_dir, args.assignments or api.get_assignments(), preview=preview)
+    return True
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    canvas_token = os.environ.get(TOKEN_ENV)
+    if args.url is None or canvas_token is None:
+        print('A canvas url (--url or config) and ${} are required'.format(TOKEN_ENV), file=sys.stderr)
+        return EXIT_USAGE
+
+    unknown = [action for action in args.actions or [] if action not in ACTIONS]
+    if unknown:
+        print('Unknown actions: {}, expected any of: {}'.format(', '.join(unknown), ', '.join(ACTIONS)),
+              file=sys.stderr)
+        return EXIT_USAGE
+
+    try:
+        api = API(args.url, canvas_token)
+        api.enable_response_cache(pathlib.Path('terms') / '.http_cache')
+        print('Running as', api.get_current_user_name())
+        term_name, courses = api.get_latest_courses()
+    except (CanvasException, RequestException) as e:
+        print('Could not reach canvas: {}'.format(e), file=sys.stderr)
+        return EXIT_CANVAS
+
+    if args.list_courses:
+        print('\n'.join(sorted(courses)))
+        return EXIT_OK
+
+    if args.course not in courses:
+        print('Course {} not found, available: {}'.format(args.course, ', '.join(sorted(courses))), file=sys.stderr)
+        return EXIT_NO_COURSE
+
+    if not args.actions:
+        print('No actions given, expected any of: {}'.format(', '.join(ACTIONS)), file=sys.stderr)
+        return EXIT_USAGE
+
+    api.set_current_course(args.course, courses[args.course])
+    course_dir = pathlib.Path('terms') / args.course
+    course_dir.mkdir(exist_ok=True, parents=True)
+    api.set_course_dir(course_dir)
+
+    # The report covers the actions, not connecting to canvas
+    get_metrics().reset()
+
+    # Later actions build on earlier ones, so stop at the first failure
+    exit_code = EXIT_OK
+    for action in args.actions:
+        print('=' * 40)
+        print('Action:', action)
+        print('=' * 40)
+        try:
+            succeeded = run_action(action, api, course_dir, args)
+        except (CanvasException, RequestException) as e:
+            print('{} failed talking to canvas: {}'.format(action, e), file=sys.stderr)
+            exit_code = EXIT_CANVAS
+            break
+        except Exception:
+            traceback.print_exc()
+            succeeded = False
+        if not succeeded:
+            print('{} failed'.format(action), file=sys.stderr)
+            exit_code = EXIT_ACTION_FAILED
+            break
+
+    # Failed runs are reported too, they are the ones worth looking into
+    json_path, prom_path = write_run_report(course_dir, args.actions)
+    print('Run report:', json_path)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
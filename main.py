@@ -2,18 +2,12 @@ import os
 import sys
 import pathlib
 
-from canvasapi import Canvas
-
 from util.gui import GuiWindow
 from util.gui import BetterConfig
-from util.moss import *
-from util.api import API
-from util.process import *
-from util.plot_grade import plot_grade
-from util.plot_late import plot_late
+from util.metrics import get_metrics, write_run_report
 
-from tkinter import filedialog
-import tkinter as tk
+# Heavy dependencies (pandas, canvasapi, matplotlib, networkx) are imported by the action that needs them,
+# so the credential window shows up right away
 
 
 def main():
@@ -42,35 +36,17 @@ def main():
     '''
 
     # Initialize a new API object
+    from util.api import API
     api = API(canvas_url, canvas_token)
 
+    # Cache canvas responses between actions and sessions
+    api.enable_response_cache(pathlib.Path('terms') / '.http_cache')
+
     # Get username
     canvas_user_name = api.get_current_user_name()
 
     # Get latest courses only
-    latest_course_id = -1
-    courses = dict()
-    term_name = str()
-
-    # Iterate through courses
-    for i in api.get_courses():
-        if not hasattr(i, 'enrollment_term_id') or i.enrollment_term_id is None:
-            continue  # Skip courses without a valid enrollment term ID
-
-        if i.enrollment_term_id > latest_course_id:
-            latest_course_id = i.enrollment_term_id
-            courses = dict()
-            term_name = i.name
-
-        if i.enrollment_term_id != latest_course_id:
-            continue
-
-        if i.course_code not in courses:
-            courses[i.course_code] = list()
-        courses[i.course_code].append(i.id)
-
-    # create term name from course title
-    term_name = '_'.join(reversed(term_name.split('-')[0:2]))
+    term_name, courses = api.get_latest_courses()
 
     # Update title to show current token holder
     gui.title('Canvas Lab Manager - {name}'.format(name=canvas_user_name))
@@ -87,11 +63,17 @@ def main():
 
     api.set_course_dir(course_dir)
 
+    # Plots render as quick previews unless full resolution was asked for
+    preview = config.get('plot_resolution', 'preview') == 'preview'
+
     # Run actions
     while True:
         # Get selected action in string form
         selected_action = gui.get_action_selection()
 
+        # Each action's report starts when it does, not when the menu was shown
+        get_metrics().reset()
+
         if selected_action == 'exit':
             break
         elif selected_action == 'create_gradebook':
@@ -113,15 +95,34 @@ def main():
                 list_of_assignments.append(assignment.name)
                 list_of_assignments = list(sorted(list_of_assignments))
             selected_assignments = gui.get_assignment_selection(list_of_assignments)
+            from util.moss import run_moss
             run_moss(course_dir, selected_assignments, 'cc')
         elif selected_action == 'generate_cheating_spreadsheet':
-            process_moss(course_dir)
+            from util.process import process_moss
+            process_moss(course_dir, preview=preview)
+        elif selected_action == 'generate_cheating_spreadsheet_offline':
+            from util.process import process_moss
+            process_moss(course_dir, engine='local', preview=preview)
+        elif selected_action == 'check_prior_terms':
+            from util.fingerprints import check_prior_terms
+            check_prior_terms(course_dir, term_name)
         elif selected_action == 'grading_status':
-            plot_grade(course_dir, api.get_assignments())
+            from util.plot_grade import plot_grade
+            plot_grade(course_dir, api.get_assignments(), preview=preview)
         elif selected_action == 'late_status':
-            plot_late(course_dir, api.get_assignments())
+            from util.plot_late import plot_late
+            plot_late(course_dir, api.get_assignments(), preview=preview)
+        elif selected_action == 'toggle_resolution':
+            preview = not preview
+            config.set('plot_resolution', 'preview' if preview else 'full')
+            print('Plots will render at {} resolution'.format('preview' if preview else 'full'))
         else:
             print('Selected Action is not yet implemented!!')
+            continue
+
+        # One report per action, under the course's metrics dir
+        if selected_action not in ('switch_course', 'toggle_resolution'):
+            write_run_report(course_dir, [selected_action])
 
     # Destroy gui window at end
     gui.destroy()
@@ -1,14 +1,34 @@
 # Import the Canvas class
 import copy
+import json
+import multiprocessing
+import os
 import pandas as pd
 import pathlib
 import shutil
-import zipfile
-import py7zr
-import re
+import time
+import threading
+import requests
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
 from canvasapi import Canvas
 from canvasapi.course import Course
+from canvasapi.paginated_list import PaginatedList
+from canvasapi.submission import Submission
+from canvasapi.util import combine_kwargs
+
+from util.cache import ResponseCache, CachingAdapter
+from util.store import save_frame
+from util.extract import process_submission
+from util.blobs import BlobStore, attachment_key
+from util.fingerprints import FingerprintIndex
+from util.metrics import RequestCounter, get_metrics, stage
+
+
+# Incremental gradebook syncs fall back on a full fetch once the last one is this old
+FULL_SYNC_HOURS = 24
 
 
 # API Class for managing all API calls to canvas
@@ -21,14 +41,38 @@ class API:
 
         # Create canvas object
         self.canvas = Canvas(self.canvas_url, self.canvas_token)
+        self.requester = self.canvas._Canvas__requester
+
+        # Count round trips made through canvasapi
+        self.request_counter = RequestCounter()
+        self.requester._session.hooks['response'].append(self.request_counter)
 
         # Other
+        self.term_name = None
         self.course_ids = None
         self.course_name = None
         self.course_dir = None
+        self.download_session = None
+        self.response_cache = None
 
         return
 
+    # Serve canvas GET requests through a persistent on-disk cache
+    def enable_response_cache(self, cache_dir: pathlib.Path, ttl: float = 300,
+                              max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.response_cache = ResponseCache(cache_dir, ttl=ttl, max_bytes=max_bytes)
+        self.mount_adapter()
+        return
+
+    # Mount the adapter used for canvas requests, sized for pool_size concurrent requests
+    def mount_adapter(self, pool_size: int = 10) -> None:
+        if self.response_cache is None:
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+        else:
+            adapter = CachingAdapter(self.response_cache, pool_maxsize=pool_size)
+        self.requester._session.mount(self.requester.original_url, adapter)
+        return
+
     # Get current user, based on token access
     def get_current_user_name(self):
         return self.canvas.get_current_user().name
@@ -37,6 +81,37 @@ class API:
     def get_courses(self):
         return self.canvas.get_courses()
 
+    # Courses of the latest enrollment term, returns the term name and course code -> section ids
+    def get_latest_courses(self) -> tuple:
+        latest_course_id = -1
+        courses = dict()
+        term_name = str()
+
+        # Iterate through courses
+        for i in self.get_courses():
+            if not hasattr(i, 'enrollment_term_id') or i.enrollment_term_id is None:
+                continue  # Skip courses without a valid enrollment term ID
+
+            if i.enrollment_term_id > latest_course_id:
+                latest_course_id = i.enrollment_term_id
+                courses = dict()
+                term_name = i.name
+
+            if i.enrollment_term_id != latest_course_id:
+                continue
+
+            if i.course_code not in courses:
+                courses[i.course_code] = list()
+            courses[i.course_code].append(i.id)
+
+        # create term name from course title
+        term_name = '_'.join(reversed(term_name.split('-')[0:2]))
+
+        # Submissions downloaded from now on are indexed under this term
+        self.term_name = term_name
+
+        return term_name, courses
+
     # Set current course name and course id list (associated with name)
     def set_current_course(self, course_name: str, course_ids: list) -> None:
         self.course_name = course_name
@@ -48,45 +123,78 @@ class API:
         self.course_dir = course_dir
         return
 
-    def download_information(self, download_student_code: bool = False,
-                             assignments_list: list = None, gui=None) -> None:
-        print("Course:", self.course_name)
-        all_data = None
-        all_tas = None
-
-        # Iterate through all subsections of course
-        for course_ind, course_id in enumerate(self.course_ids):
-            print("\tCourse Section:", course_id)
-            course = self.canvas.get_course(course_id)
-
-            student_info = get_students_info(course)
+    # Shared, pooled HTTP session used by the attachment download workers
+    def get_download_session(self, pool_size: int) -> requests.Session:
+        if self.download_session is None:
+            self.download_session = create_download_session(self.canvas_token, pool_size)
+        return self.download_session
 
-            ta_info = get_section_graders(course)
+    # Fetch everything needed from one course section, returns (course, student_info, ta_info, grade_book)
+    def harvest_section(self, course_id: int, bulk_submissions: bool = True, incremental: bool = True) -> tuple:
+        print("\tCourse Section:", course_id)
+        course = self.canvas.get_course(course_id)
 
-            assignments = get_grade_book(course)
+        student_info = get_students_info(course)
 
-            if download_student_code:
-                download_submissions(course, self.course_dir, student_info, ta_info, assignments_list,
-                                     gui, 100 / len(self.course_ids))
+        ta_info = get_section_graders(course)
 
-            final_scores = get_cumulative_score(course)
+        round_trips = self.request_counter.thread_count()
+        if incremental:
+            assignments = sync_grade_book(course, self.course_dir / '.sync', student_info['ID'], bulk=bulk_submissions)
+        else:
+            assignments = get_grade_book(course, bulk=bulk_submissions)
+        print("\t\tSection {id} gradebook: {count} round trips ({mode})".format(
+            id=course_id, count=self.request_counter.thread_count() - round_trips,
+            mode='bulk' if bulk_submissions else 'per assignment'))
 
-            grade_book = pd.merge(student_info, assignments, on='ID')
-            grade_book = pd.merge(grade_book, final_scores, on='ID')
+        final_scores = get_cumulative_score(course)
 
-            if all_data is None:
-                all_data = grade_book
-            else:
-                all_data = pd.concat([all_data, grade_book], ignore_index=True)
+        grade_book = pd.merge(student_info, assignments, on='ID')
+        grade_book = pd.merge(grade_book, final_scores, on='ID')
 
-            if all_tas is None:
-                all_tas = ta_info
-            else:
-                all_tas = pd.concat([all_tas, ta_info], ignore_index=True)
+        return course, student_info, ta_info, grade_book
 
-            # Update gui
-            if not download_student_code:
-                gui.set_progress_bar(100 / len(self.course_ids))
+    # Harvest every section's gradebook, and their submissions with download_student_code,
+    # returns how many submissions failed to download or extract
+    def download_information(self, download_student_code: bool = False,
+                             assignments_list: list = None, gui=None, download_workers: int = 8,
+                             section_workers: int = 4, bulk_submissions: bool = True,
+                             incremental: bool = True, extract_workers: int = None) -> int:
+        print("Course:", self.course_name)
+        step = 100 / len(self.course_ids)
+        round_trips = self.request_counter.total
+
+        # Sections are independent, so harvest up to section_workers of them at once
+        section_workers = max(min(section_workers, len(self.course_ids)), 1)
+        self.mount_adapter(max(section_workers, 10))
+
+        sections = dict()
+        failed = 0
+        with stage('harvest_sections'):
+            with ThreadPoolExecutor(max_workers=section_workers) as executor:
+                futures = {executor.submit(self.harvest_section, course_id, bulk_submissions, incremental): course_id
+                           for course_id in self.course_ids}
+                for future in as_completed(futures):
+                    sections[futures[future]] = future.result()
+
+                    # Update gui
+                    if not download_student_code and gui is not None:
+                        gui.set_progress_bar(step)
+
+        # Downloads stay on this thread since they drive the gui themselves
+        if download_student_code:
+            with stage('download_submissions'), create_extract_pool(extract_workers) as extract_pool:
+                for course_id in self.course_ids:
+                    course, student_info, ta_info, _ = sections[course_id]
+                    failed += download_submissions(course, self.course_dir, student_info, ta_info,
+                                                   assignments_list, gui, step,
+                                                   session=self.get_download_session(download_workers),
+                                                   workers=download_workers, extract_pool=extract_pool,
+                                                   term=self.term_name)
+
+        # Merge in section order so the output matches a serial run
+        all_data = pd.concat([sections[course_id][3] for course_id in self.course_ids], ignore_index=True)
+        all_tas = pd.concat([sections[course_id][2] for course_id in self.course_ids], ignore_index=True)
 
         # Copy late data
         all_data_late = copy.deepcopy(all_data)
@@ -96,10 +204,15 @@ class API:
             if '-Late' in column_name:
                 all_data = all_data.drop(column_name, axis=1)
 
-        all_data.to_excel(self.course_dir / 'grade_book.xlsx')
-        all_data_late.to_excel(self.course_dir / 'grade_book_late.xlsx')
-        all_tas.to_excel(self.course_dir / 'ta_list.xlsx')
-        return
+        with stage('save_gradebook'):
+            save_frame(self.course_dir, 'grade_book', all_data)
+            save_frame(self.course_dir, 'grade_book_late', all_data_late)
+            save_frame(self.course_dir, 'ta_list', all_tas)
+
+        print("Canvas round trips:", self.request_counter.total - round_trips)
+        if failed > 0:
+            print("Submissions failed:", failed)
+        return failed
 
     def get_assignments(self) -> list:
         # Get assignments from the first course in the list of course ids
@@ -133,13 +246,26 @@ def get_students_info(course_instance: Course) -> pd.DataFrame:
     return pd.DataFrame(students)
 
 
-def get_grade_book(course_instance: Course) -> pd.DataFrame:
-    course_assignments = course_instance.get_assignments()
+def get_grade_book(course_instance: Course, bulk: bool = True, per_page: int = 500) -> pd.DataFrame:
+    course_assignments = list(course_instance.get_assignments())
 
     everything = dict()
 
-    for course_assignment in course_assignments:
-        for submission in course_assignment.get_submissions():
+    if bulk:
+        # Pull every submission in the section from the multi-student, multi-assignment listing
+        by_assignment = {course_assignment.id: list() for course_assignment in course_assignments}
+        for submission in get_section_submissions(course_instance, per_page=per_page):
+            if submission.assignment_id in by_assignment:
+                by_assignment[submission.assignment_id].append(submission)
+
+        submissions = [(course_assignment, by_assignment[course_assignment.id])
+                       for course_assignment in course_assignments]
+    else:
+        submissions = [(course_assignment, course_assignment.get_submissions())
+                       for course_assignment in course_assignments]
+
+    for course_assignment, assignment_submissions in submissions:
+        for submission in assignment_submissions:
             if submission.user_id not in everything:
                 everything[submission.user_id] = dict()
 
@@ -158,6 +284,85 @@ def get_grade_book(course_instance: Course) -> pd.DataFrame:
     return section_grade_book
 
 
+def sync_grade_book(course_instance: Course, sync_dir: pathlib.Path, student_ids: pd.Series,
+                    bulk: bool = True, per_page: int = 500,
+                    max_age: timedelta = timedelta(hours=FULL_SYNC_HOURS)) -> pd.DataFrame:
+    """
+    Brings the section's stored gradebook up to date with submissions graded or submitted since the last sync.
+    Falls back on a full fetch when nothing is stored yet, the assignments or roster changed, or the last
+    full fetch is older than max_age. Lateness of missing work grows without any submission changing,
+    so only a full fetch keeps it current.
+    """
+    sync_dir.mkdir(exist_ok=True, parents=True)
+    state_path = sync_dir / '{}.json'.format(course_instance.id)
+    grade_book_path = sync_dir / '{}.pkl'.format(course_instance.id)
+
+    # Overlap the previous window a little so clock skew with canvas cannot drop a change
+    sync_started = datetime.now(timezone.utc) - timedelta(minutes=5)
+
+    course_assignments = list(course_instance.get_assignments())
+    assignment_names = {course_assignment.id: course_assignment.name for course_assignment in course_assignments}
+
+    state = None
+    if state_path.is_file() and grade_book_path.is_file():
+        with open(state_path) as f:
+            state = json.load(f)
+
+    # State saved before full fetches were timed counts as stale
+    built_at = datetime.min.replace(tzinfo=timezone.utc)
+    if state is not None and 'built_at' in state:
+        built_at = datetime.fromisoformat(state['built_at'])
+
+    if state is None or state['assignments'] != list(assignment_names.keys()) or sync_started - built_at > max_age:
+        section_grade_book = get_grade_book(course_instance, bulk=bulk, per_page=per_page)
+        built_at = sync_started
+    else:
+        section_grade_book = pd.read_pickle(grade_book_path)
+
+        # New students have no stored row, so rebuild to pick up their placeholder submissions
+        if not student_ids.isin(section_grade_book['ID']).all():
+            section_grade_book = get_grade_book(course_instance, bulk=bulk, per_page=per_page)
+            built_at = sync_started
+        else:
+            # A submission can be both graded and submitted since the last sync, keep one copy
+            changes = dict()
+            for since in ['graded_since', 'submitted_since']:
+                for submission in get_section_submissions(course_instance, per_page=per_page,
+                                                          **{since: state['synced_at']}):
+                    changes[(submission.user_id, submission.assignment_id)] = submission
+
+            section_grade_book = section_grade_book.set_index('ID')
+            for (user_id, assignment_id), submission in changes.items():
+                if assignment_id not in assignment_names:
+                    continue
+                name = assignment_names[assignment_id]
+                section_grade_book.loc[user_id, name] = submission.score
+                section_grade_book.loc[user_id, name + '-Late'] = submission.seconds_late
+            section_grade_book = section_grade_book.reset_index()
+
+            print("\t\tSection {id}: merged {count} changed submissions".format(id=course_instance.id,
+                                                                               count=len(changes)))
+
+    # Save for the next sync
+    section_grade_book.to_pickle(grade_book_path)
+    with open(state_path, 'w') as f:
+        json.dump({'synced_at': sync_started.isoformat(), 'built_at': built_at.isoformat(),
+                   'assignments': list(assignment_names.keys())}, f)
+
+    return section_grade_book
+
+
+def get_section_submissions(course_instance: Course, per_page: int = 500, **kwargs) -> PaginatedList:
+    """
+    Lists submissions for every student and assignment in a section, a few large pages at a time.
+    Canvas clamps per_page to its own maximum.
+    """
+    return PaginatedList(Submission, course_instance._requester, 'GET',
+                         'courses/{}/students/submissions'.format(course_instance.id),
+                         {'course_id': course_instance.id},
+                         _kwargs=combine_kwargs(student_ids=['all'], **kwargs), per_page=per_page)
+
+
 def get_section_graders(course_instance: Course) -> pd.DataFrame:
     head_ta_list = ['Christopher Pereyda']
     tas = list()
@@ -209,191 +414,287 @@ def get_cumulative_score(course_instance: Course) -> pd.DataFrame:
 
 
 
-def sanitize_path_component(component: str) -> str:
+def create_download_session(canvas_token: str, pool_size: int) -> requests.Session:
     """
-    Sanitizes a file or directory name by removing or replacing problematic characters.
+    Creates a requests session whose connection pool is large enough for every download worker.
     """
-    # Replace invalid characters with underscores
-    sanitized = re.sub(r'[<>:"/\\|?*]', '_', component)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Authorization': 'Bearer {}'.format(canvas_token)})
+    session.hooks['response'].append(RequestCounter('files'))
+    return session
 
-    # Ensure no control characters or leading/trailing whitespace
-    sanitized = sanitized.strip()
-
-    # Truncate overly long file names (limit to 255 characters)
-    return sanitized[:255]
 
+def fetch_attachment(attachment, location: pathlib.Path, session: requests.Session = None,
+                     retries: int = 3) -> int:
+    """
+    Downloads an attachment to location, retrying with backoff on network errors.
+    Returns the number of bytes written.
+    """
+    # Fall back on canvasapi's own requester when no pooled session is given
+    if session is None:
+        attachment.download(location)
+        return location.stat().st_size
 
-def process_submission(code_dir: pathlib.Path, zip_type: bool = False, zip7_type: bool = False) -> None:
-    if zip_type:
+    partial = location.with_name(location.name + '.part')
+    for attempt in range(retries + 1):
         try:
-            with zipfile.ZipFile(code_dir.with_suffix('.zip'), 'r') as zip_ref:
-                for zipinfo in zip_ref.infolist():
-                    # Sanitize file name
-                    sanitized_name = sanitize_path_component(zipinfo.filename)
-
-                    # Determine target path
-                    target_path = code_dir / sanitized_name
-
-                    # Handle path conflicts
-                    if target_path.exists() and not target_path.is_dir():
-                        print(f"Conflict detected for {target_path}. Renaming...")
-                        target_path = target_path.with_name(target_path.stem + '_conflict')
-
-                    # Ensure parent directories exist
-                    target_path.parent.mkdir(parents=True, exist_ok=True)
-
-                    # Extract file
-                    with open(target_path, 'wb') as f_out:
-                        f_out.write(zip_ref.read(zipinfo))
-        except zipfile.BadZipFile as e:
-            print(f"Invalid ZIP file for student {code_dir.name}: {e}")
-        finally:
-            # Remove the original ZIP file
-            code_dir.with_suffix('.zip').unlink(missing_ok=True)
-
-    elif zip7_type:
-        try:
-            with py7zr.SevenZipFile(code_dir.with_suffix('.7z'), mode='r') as z:
-                z.extractall(path=code_dir)
-        except Exception as e:
-            print(f"Invalid 7z file for student {code_dir.name}: {e}")
-        finally:
-            # Remove the original 7z file
-            code_dir.with_suffix('.7z').unlink(missing_ok=True)
-
-    # Check for empty directories
-    if not code_dir.is_dir():
-        print(f"Directory {code_dir} is missing or not created.")
-        return
-
-    # Extract nested ZIP files, if any
-    for nested_zip in code_dir.rglob('*.zip'):
-        if zipfile.is_zipfile(nested_zip):
-            try:
-                print(f"Processing nested ZIP: {nested_zip}")
-                with zipfile.ZipFile(nested_zip, 'r') as zip_ref:
-                    extract_target = nested_zip.parent / nested_zip.stem
-                    extract_target.mkdir(exist_ok=True)
-                    zip_ref.extractall(extract_target)
-            except Exception as e:
-                print(f"Error processing nested ZIP {nested_zip}: {e}")
-            finally:
-                # Remove the nested ZIP after extraction
-                nested_zip.unlink(missing_ok=True)
-
-    # Create a temporary directory for extracted code
-    code_dir_tmp = pathlib.Path(str(code_dir.resolve()) + '-t')
-    code_dir_tmp.mkdir(exist_ok=True)
-
-    # Move valid code files (.c, .cpp) to the temporary directory
-    file_types = ['.c', '.cpp']
-    for file_type in file_types:
-        for file_path in code_dir.rglob('*' + file_type):
-            # Skip hidden files or invalid entries
-            if file_path.name.startswith('.') or not file_path.is_file():
-                continue
-
-            # Skip very small or corrupted files
-            if file_path.stat().st_size < 100:
-                print(f"Skipping small or corrupted file: {file_path}")
-                continue
-
-            # Ensure the file is text format
-            convert_to_text(file_path)
-
-            # Copy valid files to the temp directory
-            shutil.copy(file_path, code_dir_tmp)
-
-    # Remove the original directory and rename the temp directory
-    shutil.rmtree(code_dir)
-    code_dir_tmp.rename(code_dir)
-
-    print(f"Processing completed for: {code_dir}")
-
-    return
-
-
-def convert_to_text(path: pathlib.Path) -> None:
+            with session.get(attachment.url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                size = 0
+                with open(partial, 'wb') as f_out:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f_out.write(chunk)
+                        size += len(chunk)
+            partial.replace(location)
+            return size
+        except (requests.RequestException, OSError):
+            partial.unlink(missing_ok=True)
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def download_student_submission(attachment, code_dir: pathlib.Path, student_name: str,
+                                session: requests.Session = None, retries: int = 3) -> tuple:
     """
-    Converts a file to UTF-8 encoding if necessary to ensure compatibility.
+    Downloads one student's latest attachment next to (or into) code_dir / student_name.
+    Returns the number of bytes downloaded and whether it is a zip or 7z archive.
     """
-    try:
-        with open(path, 'r', encoding='utf-16') as f_in:
-            content = f_in.read()
-        with open(path, 'w', encoding='utf-8') as f_out:
-            f_out.write(content)
-    except UnicodeError:
-        print(f"File {path} is not in UTF-16 format or conversion failed. Skipping conversion.")
+    # Grab student file name
+    student_file_name = attachment.filename
 
+    zip_type = False
+    zip7_type = False
 
-def download_submissions(course_instance: Course, course_dir: pathlib.Path,
-                         student_info: pd.DataFrame, ta_info: pd.DataFrame, assignments_list: list, gui, step) -> None:
+    try:
+        if '.zip' == student_file_name[-4:]:
+            # Download zip file
+            size = fetch_attachment(attachment, code_dir / (student_name + '.zip'), session, retries)
+            zip_type = True
 
-    course_assignments = course_instance.get_assignments()
-    for course_assignment in course_assignments:
-        if assignments_list is not None:
-            if course_assignment.name not in assignments_list:
-                continue
+        elif '.7z' == student_file_name[-3:]:
+            # Download 7zip file
+            size = fetch_attachment(attachment, code_dir / (student_name + '.7z'), session, retries)
+            zip7_type = True
 
-        print('\t\tDownloading:', course_assignment.name)
+        else:
+            # Make student dir
+            student_code = code_dir / student_name
+            student_code.mkdir(exist_ok=True)
 
-        for submission in course_assignment.get_submissions():
-            # Check for a submission
-            if len(submission.attachments) == 0:
-                continue
+            # Download normal file
+            size = fetch_attachment(attachment, student_code / student_file_name, session, retries)
 
-            # Get TA name
-            try:
-                ta_name = ta_info['Name'].values[0]
-            except Exception as e:
-                # Ungraded assignment case
-                ta_name = 'N/A'
+            # Print notice to user
+            print('Warning: Student {} did not submit a zip file!'.format(student_name))
+    except Exception:
+        # Leave no partial student dir behind so the next run retries this student
+        shutil.rmtree(code_dir / student_name, ignore_errors=True)
+        raise
 
-            ta_name = ta_name.replace(' ', '_')
+    return size, zip_type, zip7_type
 
-            # Get student name
-            student_name = student_info['Name'][student_info['ID'] == submission.user_id].values[0].replace(' ', '_')
 
-            # Setup file structure course / pa / ta / student / code
-            code_dir = course_dir / 'assignments' / course_assignment.name / ta_name
-            code_dir.mkdir(exist_ok=True, parents=True)
-
-            # Skip if we already downloaded
-            # TODO: let user overwrite and re-download (for now just del folders)
-            if (code_dir / student_name).is_dir():
-                continue
-
-            # Grab student file name
-            student_file_name = submission.attachments[-1].filename
+def create_extract_pool(extract_workers: int = None) -> ProcessPoolExecutor:
+    """
+    Process pool for the extraction stage, one worker per core by default.
+    """
+    # Spawn, forking a process that is running download threads is not safe
+    return ProcessPoolExecutor(max_workers=extract_workers or os.cpu_count() or 1,
+                               mp_context=multiprocessing.get_context('spawn'))
 
-            zip_type = False
-            zip7_type = False
 
-            if '.zip' == student_file_name[-4:]:
-                # Download zip file
-                submission.attachments[-1].download(code_dir / (student_name + '.zip'))
-                zip_type = True
+def download_and_queue(attachment, code_dir: pathlib.Path, student_name: str, session: requests.Session,
+                       retries: int, extract_pool: ProcessPoolExecutor, slots: threading.BoundedSemaphore) -> tuple:
+    """
+    Download stage of the pipeline, hands the archive to the extraction pool once a queue slot is free.
+    Returns the extraction future, bytes downloaded and seconds spent downloading.
+    """
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    size, zip_type, zip7_type = download_student_submission(attachment, code_dir, student_name, session, retries)
+    seconds = time.perf_counter() - start
+    get_metrics().record_stage('fetch_attachment', seconds, time.thread_time() - cpu_start)
+    get_metrics().add('bytes_downloaded', size)
+
+    # Backpressure, block here while the extraction queue is full
+    slots.acquire()
+    try:
+        extraction = extract_pool.submit(process_submission, code_dir / student_name,
+                                         zip_type=zip_type, zip7_type=zip7_type)
+    except Exception:
+        slots.release()
+        raise
+    extraction.add_done_callback(lambda future: slots.release())
 
-            elif '.7z' == student_file_name[-3:]:
-                # Download 7zip file
-                submission.attachments[-1].download(code_dir / (student_name + '.7z'))
-                zip7_type = True
+    return extraction, size, seconds
 
-            else:
-                # Make student dir
-                student_code = code_dir / student_name
-                student_code.mkdir(exist_ok=True)
 
-                # Download normal file
-                submission.attachments[-1].download(student_code / student_file_name)
+def download_submissions(course_instance: Course, course_dir: pathlib.Path,
+                         student_info: pd.DataFrame, ta_info: pd.DataFrame, assignments_list: list, gui, step,
+                         session: requests.Session = None, workers: int = 8, retries: int = 3,
+                         extract_pool: ProcessPoolExecutor = None, queue_size: int = None,
+                         store: BlobStore = None, index: FingerprintIndex = None, term: str = None) -> int:
+    """
+    Downloads and extracts submissions as a pipeline, a thread pool of downloaders feeds a bounded
+    queue that a process pool of extractors drains, so network and decompression overlap.
+    Attachments already in the course blob store are rebuilt from it without touching the network.
+    Every extracted student is added to the fingerprint index shared by all terms, under term.
+    Failed students are reported and skipped, returns how many there were.
+    """
+    own_pool = extract_pool is None
+    if own_pool:
+        extract_pool = create_extract_pool()
+    queue_size = queue_size or 2 * (os.cpu_count() or 1)
 
-                # Print notice to user
-                print('Warning: Student {} did not submit a zip file!'.format(student_name))
+    own_store = store is None
+    if own_store:
+        store = BlobStore(course_dir / '.blobs')
 
-            # Extract out code
-            process_submission(code_dir / student_name, zip_type=zip_type, zip7_type=zip7_type)
+    own_index = index is None
+    if own_index:
+        index = FingerprintIndex(course_dir.parent / '.fingerprints.sqlite')
 
-        # Update gui
-        gui.set_progress_bar(step / len(assignments_list))
+    failed = 0
+    try:
+        course_assignments = list(course_instance.get_assignments())
+        for course_assignment in course_assignments:
+            if assignments_list is not None:
+                if course_assignment.name not in assignments_list:
+                    continue
+
+            print('\t\tDownloading:', course_assignment.name)
+
+            # Collect every submission that still needs downloading
+            jobs = list()
+            reused = 0
+            for submission in course_assignment.get_submissions():
+                # Check for a submission
+                if len(submission.attachments) == 0:
+                    continue
+
+                # Get TA name
+                try:
+                    ta_name = ta_info['Name'].values[0]
+                except Exception as e:
+                    # Ungraded assignment case
+                    ta_name = 'N/A'
+
+                ta_name = ta_name.replace(' ', '_')
+
+                # Get student name
+                student_name = student_info['Name'][student_info['ID'] == submission.user_id].values[0]
+                student_name = student_name.replace(' ', '_')
+
+                # Setup file structure course / pa / ta / student / code
+                code_dir = course_dir / 'assignments' / course_assignment.name / ta_name
+                code_dir.mkdir(exist_ok=True, parents=True)
+
+                # Skip students whose dir was built from this version of their attachment,
+                # a resubmission has a new key and is rebuilt or downloaded again
+                # TODO: let user force a re-download (deleting a folder only rebuilds it from .blobs)
+                attachment = submission.attachments[-1]
+                key = attachment_key(attachment)
+                student_dir = code_dir / student_name
+                if student_dir.is_dir() and store.get_dir_key(student_dir) == key:
+                    continue
+
+                # Rebuild from the blob store when this version of the attachment was extracted before
+                if store.materialize_tree(key, student_dir):
+                    index.add_student_dir(student_dir, term)
+                    reused += 1
+                    continue
+
+                # The old submission makes way for the new one
+                if student_dir.is_dir():
+                    if store.get_dir_key(student_dir) is not None:
+                        print('\t\t\tResubmitted: {}'.format(student_name))
+                    shutil.rmtree(student_dir)
+
+                jobs.append((attachment, code_dir, student_name, key))
+
+            assignment_step = step / (len(assignments_list) if assignments_list else len(course_assignments))
+
+            # Per stage timings, summed over workers
+            start = time.perf_counter()
+            timings = {'download': 0.0, 'extract': 0.0}
+            totals = {'bytes': 0, 'kept': 0, 'skipped': 0, 'converted': 0}
+            slots = threading.BoundedSemaphore(queue_size)
+
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as download_pool:
+                owners = dict()
+                for attachment, code_dir, student_name, key in jobs:
+                    future = download_pool.submit(download_and_queue, attachment, code_dir, student_name,
+                                                  session, retries, extract_pool, slots)
+                    owners[future] = (code_dir / student_name, key, 'download')
+
+                # A student is done once their extraction finishes, or their download fails
+                done_count = 0
+                pending = set(owners)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        student_dir, key, phase = owners[future]
+                        try:
+                            if phase == 'download':
+                                extraction, size, seconds = future.result()
+                                totals['bytes'] += size
+                                timings['download'] += seconds
+                                owners[extraction] = (student_dir, key, 'extract')
+                                pending.add(extraction)
+                                continue
+
+                            stats = future.result()
+                            if stats['failed']:
+                                failed += 1
+                            timings['extract'] += stats['seconds']
+                            get_metrics().record_stage('process_submission', stats['seconds'], stats['cpu_seconds'])
+                            get_metrics().add('bytes_extracted', stats['bytes_extracted'])
+                            for outcome in ['kept', 'skipped', 'converted']:
+                                get_metrics().add('files', stats[outcome], outcome=outcome)
+                            totals['kept'] += stats['kept']
+                            totals['skipped'] += stats['skipped']
+                            totals['converted'] += stats['converted']
+
+                            # Deduplicate the extracted files into the blob store and index them
+                            if student_dir.is_dir():
+                                store.record_tree(key, student_dir)
+                                index.add_student_dir(student_dir, term)
+                        except Exception as e:
+                            print('Failed to {} submission for {}: {}'.format(phase, student_dir.name, e))
+                            failed += 1
+
+                        # Update gui with aggregate throughput
+                        done_count += 1
+                        if gui is None:
+                            continue
+                        elapsed = time.perf_counter() - start
+                        gui.set_progress_bar(assignment_step / len(jobs),
+                                             text='{name}: {done}/{total} files, {mb:.1f} MB at {rate:.2f} MB/s'.format(
+                                                 name=course_assignment.name, done=done_count, total=len(jobs),
+                                                 mb=totals['bytes'] / 1e6,
+                                                 rate=totals['bytes'] / 1e6 / max(elapsed, 1e-9)))
 
-    return
+            # Update gui
+            if len(jobs) == 0 and gui is not None:
+                gui.set_progress_bar(assignment_step)
+            get_metrics().add('attachments', len(jobs), source='canvas')
+            get_metrics().add('attachments', reused, source='blob_store')
+            if len(jobs) > 0 or reused > 0:
+                print('\t\t{name}: wall {wall:.1f}s, download {download:.1f}s, extract {extract:.1f}s (summed over '
+                      'workers), {kept} files kept, {skipped} skipped, {converted} converted to UTF-8, '
+                      '{reused} rebuilt from the blob store'.format(
+                          name=course_assignment.name, wall=time.perf_counter() - start, reused=reused,
+                          **timings, **totals))
+    finally:
+        if own_pool:
+            extract_pool.shutdown()
+        if own_store:
+            store.close()
+        if own_index:
+            index.close()
+
+    return failed
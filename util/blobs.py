@@ -0,0 +1,111 @@
+import os
+import pathlib
+import shutil
+import sqlite3
+
+from util.hashing import hash_file
+
+
+def attachment_key(attachment) -> str:
+    """
+    Identifies one version of a canvas attachment by id, size and last update.
+    """
+    return '{}:{}:{}'.format(attachment.id, getattr(attachment, 'size', ''), getattr(attachment, 'updated_at', ''))
+
+
+def link_or_copy(source: pathlib.Path, target: pathlib.Path) -> None:
+    """
+    Hardlinks source to target, copying instead where hardlinks are not supported.
+    """
+    tmp_target = target.with_name(target.name + '.link')
+    tmp_target.unlink(missing_ok=True)
+    try:
+        os.link(source, tmp_target)
+    except OSError:
+        shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+    return
+
+
+class BlobStore:
+    """
+    Content-addressed store of a course's submission files.
+    Every distinct file is kept once under objects/, student trees are hardlinks into it,
+    and the extracted tree of each attachment version is remembered so it can be rebuilt offline.
+    Each student dir also remembers the attachment version it was built from, so resubmissions are noticed.
+    """
+
+    def __init__(self, store_dir: pathlib.Path) -> None:
+        self.store_dir = store_dir
+        self.objects_dir = store_dir / 'objects'
+        self.objects_dir.mkdir(exist_ok=True, parents=True)
+
+        self.db = sqlite3.connect(str(store_dir / 'index.sqlite'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS trees (attachment TEXT, name TEXT, digest TEXT, '
+                        'PRIMARY KEY (attachment, name))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS attachments (attachment TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, attachment TEXT)')
+        self.db.commit()
+        return
+
+    def object_path(self, digest: str) -> pathlib.Path:
+        return self.objects_dir / digest[:2] / digest
+
+    # Student dirs are keyed by their path relative to the course dir, which holds the store
+    def dir_name(self, student_dir: pathlib.Path) -> str:
+        return pathlib.Path(os.path.relpath(student_dir, self.store_dir.parent)).as_posix()
+
+    # Attachment version a student dir was last built from, None when it predates the store
+    def get_dir_key(self, student_dir: pathlib.Path) -> str:
+        row = self.db.execute('SELECT attachment FROM dirs WHERE path = ?', (self.dir_name(student_dir),)).fetchone()
+        return None if row is None else row[0]
+
+    def set_dir_key(self, student_dir: pathlib.Path, key: str) -> None:
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (self.dir_name(student_dir), key))
+        self.db.commit()
+        return
+
+    # Adds a file to the store and swaps it for a hardlink to the stored copy
+    def put(self, path: pathlib.Path) -> str:
+        digest = hash_file(path)
+        object_path = self.object_path(digest)
+        if object_path.is_file():
+            link_or_copy(object_path, path)
+        else:
+            object_path.parent.mkdir(exist_ok=True)
+            link_or_copy(path, object_path)
+        return digest
+
+    # Stores every file of an extracted student dir under the attachment version it came from
+    def record_tree(self, key: str, student_dir: pathlib.Path) -> None:
+        rows = list()
+        for file_path in sorted(student_dir.iterdir()):
+            if file_path.is_file():
+                rows.append((key, file_path.name, self.put(file_path)))
+
+        self.db.execute('DELETE FROM trees WHERE attachment = ?', (key,))
+        self.db.executemany('INSERT INTO trees VALUES (?, ?, ?)', rows)
+        self.db.execute('INSERT OR IGNORE INTO attachments VALUES (?)', (key,))
+        self.set_dir_key(student_dir, key)
+        return
+
+    # Rebuilds a student dir from the store, replacing whatever it held,
+    # False when that attachment version was never stored
+    def materialize_tree(self, key: str, student_dir: pathlib.Path) -> bool:
+        if self.db.execute('SELECT 1 FROM attachments WHERE attachment = ?', (key,)).fetchone() is None:
+            return False
+
+        rows = self.db.execute('SELECT name, digest FROM trees WHERE attachment = ?', (key,)).fetchall()
+        if not all(self.object_path(digest).is_file() for _, digest in rows):
+            return False
+
+        shutil.rmtree(student_dir, ignore_errors=True)
+        student_dir.mkdir(parents=True)
+        for name, digest in rows:
+            link_or_copy(self.object_path(digest), student_dir / name)
+        self.set_dir_key(student_dir, key)
+        return True
+
+    def close(self) -> None:
+        self.db.close()
+        return
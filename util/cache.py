@@ -0,0 +1,171 @@
+import hashlib
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+class ResponseCache:
+    """
+    Persistent cache of GET responses, an SQLite index plus one body file per entry.
+    Entries are fresh for ttl seconds, then revalidated with their ETag / Last-Modified.
+    Least recently used entries are evicted once the bodies exceed max_bytes.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, ttl: float = 300, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.cache_dir / 'index.sqlite'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, url TEXT, headers TEXT, '
+                        'etag TEXT, last_modified TEXT, stored_at REAL, accessed_at REAL, size INTEGER)')
+        self.db.commit()
+        return
+
+    # Entries are keyed by url (params included) and the token used, so users never share responses
+    @staticmethod
+    def get_key(request: requests.PreparedRequest) -> str:
+        key = hashlib.sha256()
+        key.update(request.method.encode())
+        key.update(request.url.encode())
+        key.update(request.headers.get('Authorization', '').encode())
+        return key.hexdigest()
+
+    def get(self, key: str) -> dict:
+        with self.lock:
+            row = self.db.execute('SELECT url, headers, etag, last_modified, stored_at FROM entries WHERE key = ?',
+                                  (key,)).fetchone()
+        if row is None or not self._body_path(key).is_file():
+            return None
+
+        entry = {'url': row[0], 'headers': json.loads(row[1]), 'etag': row[2], 'last_modified': row[3],
+                 'stored_at': row[4]}
+        entry['fresh'] = time.time() - entry['stored_at'] < self.ttl
+
+        # Expired entries that cannot be revalidated are useless
+        if not entry['fresh'] and entry['etag'] is None and entry['last_modified'] is None:
+            self.delete(key)
+            return None
+
+        return entry
+
+    def put(self, key: str, response: requests.Response) -> None:
+        body = response.content
+        body_path = self._body_path(key)
+        body_path.parent.mkdir(exist_ok=True)
+        tmp_path = body_path.with_suffix('.tmp' + str(threading.get_ident()))
+        tmp_path.write_bytes(body)
+        tmp_path.replace(body_path)
+
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (key, response.url, json.dumps(dict(response.headers)),
+                             response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                             now, now, len(body)))
+            self.db.commit()
+        self.evict()
+        return
+
+    # Marks an entry as used, and as revalidated when the server answered 304
+    def touch(self, key: str, revalidated: bool = False) -> None:
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.db.execute('UPDATE entries SET accessed_at = ?, stored_at = ? WHERE key = ?', (now, now, key))
+            else:
+                self.db.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+            self.db.commit()
+        return
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.db.commit()
+        self._body_path(key).unlink(missing_ok=True)
+        return
+
+    # Drops least recently used entries until the cache fits in max_bytes
+    def evict(self) -> None:
+        with self.lock:
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = list()
+            for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed_at'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+            self.db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+            self.db.commit()
+        for key in evicted:
+            self._body_path(key).unlink(missing_ok=True)
+        return
+
+    def build_response(self, key: str, entry: dict, request: requests.PreparedRequest) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response._content = self._body_path(key).read_bytes()
+        return response
+
+    def _body_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / key[:2] / key
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Transport adapter that answers GET requests from a ResponseCache when it can.
+    """
+
+    def __init__(self, cache: ResponseCache, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.cache = cache
+        return
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != 'GET' or kwargs.get('stream'):
+            return super().send(request, **kwargs)
+
+        key = self.cache.get_key(request)
+        entry = self.cache.get(key)
+
+        # Fresh hit, no network at all
+        if entry is not None and entry['fresh']:
+            self.cache.touch(key)
+            response = self.cache.build_response(key, entry, request)
+            response.from_cache = True
+            return response
+
+        # Stale hit, ask the server whether it changed
+        if entry is not None:
+            if entry['etag'] is not None:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.touch(key, revalidated=True)
+            return self.cache.build_response(key, entry, request)
+
+        if response.status_code == 200:
+            self.cache.put(key, response)
+
+        return response
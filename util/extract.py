@@ -0,0 +1,320 @@
+import codecs
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+import py7zr
+
+
+# Only these files are kept from a submission
+SOURCE_TYPES = ['.c', '.cpp']
+
+# Files smaller than this are treated as empty or corrupted
+MIN_SOURCE_BYTES = 100
+
+# Per-archive budgets, nested archives count against their parent
+MAX_ARCHIVE_BYTES = 100 * 1024 * 1024
+MAX_ARCHIVE_ENTRIES = 10000
+MAX_NESTING = 3
+
+# Nested archives up to this size are unpacked in memory, larger ones spill to a temp file
+SPOOL_BYTES = 8 * 1024 * 1024
+CHUNK_BYTES = 1024 * 1024
+
+# Leading bytes looked at when detecting UTF-16
+SNIFF_BYTES = 4096
+
+
+class ExtractionLimitError(Exception):
+    """
+    Raised when an archive goes over its byte or entry budget.
+    """
+    pass
+
+
+class ExtractionBudget:
+    """
+    Tracks bytes written and entries seen while extracting one submission.
+    """
+
+    def __init__(self, max_bytes: int = MAX_ARCHIVE_BYTES, max_entries: int = MAX_ARCHIVE_ENTRIES) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self.entries = 0
+        return
+
+    def add_entry(self) -> None:
+        self.entries += 1
+        if self.entries > self.max_entries:
+            raise ExtractionLimitError('more than {} entries'.format(self.max_entries))
+        return
+
+    def add_bytes(self, count: int) -> None:
+        self.bytes += count
+        if self.bytes > self.max_bytes:
+            raise ExtractionLimitError('more than {} bytes'.format(self.max_bytes))
+        return
+
+
+def sanitize_path_component(component: str) -> str:
+    """
+    Sanitizes a file or directory name by removing or replacing problematic characters.
+    """
+    # Replace invalid characters with underscores
+    sanitized = re.sub(r'[<>:"/\\|?*]', '_', component)
+
+    # Ensure no control characters or leading/trailing whitespace
+    sanitized = sanitized.strip()
+
+    # Truncate overly long file names (limit to 255 characters)
+    return sanitized[:255]
+
+
+def is_source_name(name: str) -> bool:
+    """
+    True for .c/.cpp members that are not hidden files or macOS resource forks.
+    """
+    path = pathlib.PurePosixPath(name.replace('\\', '/'))
+    if path.suffix not in SOURCE_TYPES:
+        return False
+    return not any(part.startswith('.') or part == '__MACOSX' for part in path.parts)
+
+
+def copy_stream(source, target, budget: ExtractionBudget) -> int:
+    """
+    Copies source to target in chunks, charging every chunk to budget.
+    """
+    written = 0
+    for chunk in iter(lambda: source.read(CHUNK_BYTES), b''):
+        budget.add_bytes(len(chunk))
+        target.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def extract_zip(archive, code_dir: pathlib.Path, budget: ExtractionBudget, stats: dict,
+                depth: int = 0) -> None:
+    """
+    Streams the source members of a zip (path or file object) into code_dir, recursing into nested zips.
+    Top level members keep their sanitized path as a flat name, nested members keep their base name.
+    """
+    with zipfile.ZipFile(archive, 'r') as zip_ref:
+        for zipinfo in zip_ref.infolist():
+            if zipinfo.is_dir():
+                continue
+
+            budget.add_entry()
+
+            if zipinfo.filename.lower().endswith('.zip') and depth < MAX_NESTING:
+                try:
+                    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+                        with zip_ref.open(zipinfo) as f_in:
+                            copy_stream(f_in, spool, budget)
+                        spool.seek(0)
+                        print(f"Processing nested ZIP: {zipinfo.filename}")
+                        extract_zip(spool, code_dir, budget, stats, depth + 1)
+                except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                    print(f"Error processing nested ZIP {zipinfo.filename}: {e}")
+                continue
+
+            if not is_source_name(zipinfo.filename):
+                stats['skipped'] += 1
+                continue
+
+            if zipinfo.file_size < MIN_SOURCE_BYTES:
+                print(f"Skipping small or corrupted file: {zipinfo.filename}")
+                stats['skipped'] += 1
+                continue
+
+            if depth == 0:
+                target_name = sanitize_path_component(zipinfo.filename)
+            else:
+                target_name = sanitize_path_component(pathlib.PurePosixPath(zipinfo.filename).name)
+
+            try:
+                with zip_ref.open(zipinfo) as f_in, open(code_dir / target_name, 'wb') as f_out:
+                    stats['bytes_extracted'] += copy_stream(f_in, f_out, budget)
+            except ExtractionLimitError:
+                # Never leave a truncated file behind
+                (code_dir / target_name).unlink(missing_ok=True)
+                raise
+            stats['kept'] += 1
+    return
+
+
+def extract_7z(archive: pathlib.Path, code_dir: pathlib.Path, budget: ExtractionBudget, stats: dict) -> None:
+    """
+    Extracts only the source members and nested zips of a 7z archive into code_dir, through a temp directory.
+    """
+    with py7zr.SevenZipFile(archive, mode='r') as z:
+        targets = list()
+        for info in z.list():
+            if info.is_directory:
+                continue
+            budget.add_entry()
+            if is_source_name(info.filename) or info.filename.lower().endswith('.zip'):
+                budget.add_bytes(info.uncompressed)
+                targets.append(info.filename)
+            else:
+                stats['skipped'] += 1
+
+        if len(targets) == 0:
+            return
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            z.extract(path=tmp_dir, targets=targets)
+            for file_path in sorted(pathlib.Path(tmp_dir).rglob('*')):
+                if not file_path.is_file():
+                    continue
+                if file_path.suffix.lower() == '.zip':
+                    try:
+                        print(f"Processing nested ZIP: {file_path.name}")
+                        extract_zip(file_path, code_dir, budget, stats, depth=1)
+                    except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                        print(f"Error processing nested ZIP {file_path.name}: {e}")
+                    continue
+                keep_file(file_path, code_dir / sanitize_path_component(file_path.name), stats)
+    return
+
+
+def keep_file(file_path: pathlib.Path, target: pathlib.Path, stats: dict) -> None:
+    """
+    Moves a loose source file into place unless it is too small to be real code.
+    """
+    size = file_path.stat().st_size
+    if size < MIN_SOURCE_BYTES:
+        print(f"Skipping small or corrupted file: {file_path}")
+        stats['skipped'] += 1
+        file_path.unlink()
+        return
+    if file_path != target:
+        shutil.move(file_path, target)
+    stats['kept'] += 1
+    stats['bytes_extracted'] += size
+    return
+
+
+def process_submission(code_dir: pathlib.Path, zip_type: bool = False, zip7_type: bool = False,
+                       max_bytes: int = MAX_ARCHIVE_BYTES, max_entries: int = MAX_ARCHIVE_ENTRIES) -> dict:
+    """
+    Leaves only the student's .c/.cpp files, flattened, in code_dir.
+    Archives are streamed member by member and nothing but source is written to disk.
+    A broken, encrypted or unsupported archive fails only this student, it is reported and leaves no dir behind.
+    Returns counts of kept, skipped and converted files, bytes extracted, the wall and cpu seconds taken
+    and whether the archive failed.
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    stats = {'kept': 0, 'skipped': 0, 'converted': 0, 'bytes_extracted': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+             'failed': False}
+    budget = ExtractionBudget(max_bytes, max_entries)
+
+    # Extract into a temporary directory so a failed archive leaves no student dir behind
+    code_dir_tmp = pathlib.Path(str(code_dir.resolve()) + '-t')
+    shutil.rmtree(code_dir_tmp, ignore_errors=True)
+    code_dir_tmp.mkdir()
+
+    try:
+        try:
+            if zip_type:
+                extract_zip(code_dir.with_suffix('.zip'), code_dir_tmp, budget, stats)
+            elif zip7_type:
+                extract_7z(code_dir.with_suffix('.7z'), code_dir_tmp, budget, stats)
+            elif code_dir.is_dir():
+                # Loose file submission
+                for file_path in list(code_dir.rglob('*')):
+                    if not file_path.is_file():
+                        continue
+                    if not is_source_name(file_path.name):
+                        stats['skipped'] += 1
+                        continue
+                    keep_file(file_path, code_dir_tmp / file_path.name, stats)
+            else:
+                print(f"Directory {code_dir} is missing or not created.")
+                return stats
+        except ExtractionLimitError as e:
+            # Keep whatever source made it out before the budget ran out
+            print(f"Stopped extracting for student {code_dir.name}, archive has {e}")
+        except Exception as e:
+            # Corrupt members, encrypted or unsupported archives, anything the archive libraries raise
+            if not (zip_type or zip7_type):
+                raise
+            print(f"Invalid {'ZIP' if zip_type else '7z'} file for student {code_dir.name}: {e}")
+            stats['failed'] = True
+            return stats
+        finally:
+            # Remove the original archive
+            code_dir.with_suffix('.zip').unlink(missing_ok=True)
+            code_dir.with_suffix('.7z').unlink(missing_ok=True)
+
+        # Ensure the kept files are UTF-8 text
+        for file_path in code_dir_tmp.iterdir():
+            if convert_to_text(file_path) is not None:
+                stats['converted'] += 1
+
+        # Swap the temp directory in for the student dir
+        shutil.rmtree(code_dir, ignore_errors=True)
+        code_dir_tmp.rename(code_dir)
+    finally:
+        # Nothing is left once the swap happened, on every other path the temp dir goes
+        shutil.rmtree(code_dir_tmp, ignore_errors=True)
+
+    print(f"Processing completed for: {code_dir}")
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['cpu_seconds'] = time.process_time() - cpu_start
+    return stats
+
+
+def detect_encoding(data: bytes) -> str:
+    """
+    Returns the encoding of source that needs converting to UTF-8, None for ASCII and UTF-8.
+    Only the BOM and a leading sample are sniffed for UTF-16.
+    """
+    sample = data[:SNIFF_BYTES]
+
+    if sample.startswith(codecs.BOM_UTF8):
+        return None
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    # UTF-16 without a BOM, code is mostly ASCII so every other byte is NUL
+    if b'\0' in sample:
+        even_nuls = sample[0::2].count(0)
+        odd_nuls = sample[1::2].count(0)
+        if odd_nuls > len(sample) // 4 and even_nuls == 0:
+            return 'utf-16-le'
+        if even_nuls > len(sample) // 4 and odd_nuls == 0:
+            return 'utf-16-be'
+
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+    return None
+
+
+def convert_to_text(path: pathlib.Path) -> str:
+    """
+    Converts a UTF-16 or Latin-1 file to UTF-8 in place, replacing it atomically.
+    Returns the encoding converted from, or None when the file was left alone.
+    """
+    data = path.read_bytes()
+    encoding = detect_encoding(data)
+    if encoding is None:
+        return None
+
+    try:
+        content = data.decode(encoding)
+    except UnicodeDecodeError:
+        return None
+
+    tmp_path = path.with_name(path.name + '.utf8')
+    tmp_path.write_bytes(content.encode('utf-8'))
+    os.replace(tmp_path, path)
+    return encoding
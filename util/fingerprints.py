@@ -0,0 +1,179 @@
+import pathlib
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from util.similarity import tokenize, fingerprint
+
+
+class FingerprintIndex:
+    """
+    Inverted index from winnowed code fingerprints to the (course, assignment, TA, student, file) they came from,
+    each tagged with the term it was downloaded in. A course directory keeps every offering of its course
+    code, so the term is what tells this semester's students from earlier ones.
+    One index is shared by every course under terms/, so new submissions can be checked against past offerings.
+    Files are re-fingerprinted only when their size or mtime changed.
+    """
+
+    # Bumped whenever the tables change, older indexes are rebuilt from the trees on disk
+    SCHEMA_VERSION = 2
+
+    def __init__(self, index_path: pathlib.Path) -> None:
+        self.index_path = index_path
+        self.index_path.parent.mkdir(exist_ok=True, parents=True)
+
+        self.db = sqlite3.connect(str(index_path))
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS fingerprints')
+            self.db.execute('DROP TABLE IF EXISTS docs')
+            self.db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, course TEXT, term TEXT, '
+                        'assignment TEXT, ta TEXT, student TEXT, file TEXT, size INTEGER, mtime_ns INTEGER, '
+                        'fingerprints INTEGER, UNIQUE (course, assignment, ta, student, file))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, doc INTEGER, '
+                        'PRIMARY KEY (hash, doc)) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS fingerprints_doc ON fingerprints (doc)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS docs_term ON docs (course, term)')
+        self.db.commit()
+        return
+
+    # Adds or refreshes one file, returns False when it was already indexed as is
+    def add_file(self, course: str, term: str, assignment: str, ta: str, student: str,
+                 file_path: pathlib.Path) -> bool:
+        stat = file_path.stat()
+        row = self.db.execute('SELECT id, size, mtime_ns, term FROM docs WHERE course = ? AND assignment = ? '
+                              'AND ta = ? AND student = ? AND file = ?',
+                              (course, assignment, ta, student, file_path.name)).fetchone()
+        if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+            # A backfilled file learns its term once it is downloaded again
+            if term is not None and row[3] != term:
+                self.db.execute('UPDATE docs SET term = ? WHERE id = ?', (term, row[0]))
+            return False
+
+        tokens, _ = tokenize(file_path.read_text(encoding='utf-8', errors='replace'))
+        hashes = np.unique(fingerprint(tokens)[0]).view(np.int64)
+
+        if row is not None:
+            term = term if term is not None else row[3]
+            self.db.execute('DELETE FROM fingerprints WHERE doc = ?', (row[0],))
+            self.db.execute('DELETE FROM docs WHERE id = ?', (row[0],))
+        doc = self.db.execute('INSERT INTO docs (course, term, assignment, ta, student, file, size, mtime_ns, '
+                              'fingerprints) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (course, term, assignment, ta, student, file_path.name, stat.st_size,
+                               stat.st_mtime_ns, len(hashes))).lastrowid
+        self.db.executemany('INSERT INTO fingerprints VALUES (?, ?)', [(int(h), doc) for h in hashes])
+        return True
+
+    # Indexes every file of an extracted student dir, laid out as <course>/assignments/<PA>/<TA>/<student>.
+    # The term is None when it is not known, e.g. for trees downloaded before the index existed
+    def add_student_dir(self, student_dir: pathlib.Path, term: str = None) -> int:
+        ta_dir = student_dir.parent
+        assignment_dir = ta_dir.parent
+        course = assignment_dir.parent.parent.name
+
+        # Drop files the student no longer has, e.g. after a resubmission
+        names = [file_path.name for file_path in student_dir.iterdir() if file_path.is_file()]
+        stale = self.db.execute('SELECT id FROM docs WHERE course = ? AND assignment = ? AND ta = ? AND student = ? '
+                                'AND file NOT IN ({})'.format(','.join('?' * len(names))),
+                                [course, assignment_dir.name, ta_dir.name, student_dir.name] + names).fetchall()
+        for (doc,) in stale:
+            self.db.execute('DELETE FROM fingerprints WHERE doc = ?', (doc,))
+            self.db.execute('DELETE FROM docs WHERE id = ?', (doc,))
+
+        added = 0
+        for name in sorted(names):
+            added += self.add_file(course, term, assignment_dir.name, ta_dir.name, student_dir.name,
+                                   student_dir / name)
+        self.db.commit()
+        return added
+
+    # Students of one course indexed under the given term, as (assignment, TA, student)
+    def get_term_students(self, course: str, term: str) -> list:
+        return self.db.execute('SELECT DISTINCT assignment, ta, student FROM docs WHERE course = ? AND term = ? '
+                               'ORDER BY assignment, ta, student', (course, term)).fetchall()
+
+    # Indexes every assignment tree already on disk, only new or changed files are fingerprinted
+    def backfill(self, terms_dir: pathlib.Path) -> int:
+        added = 0
+        for student_dir in sorted(terms_dir.glob('*/assignments/*/*/*')):
+            if student_dir.is_dir():
+                added += self.add_student_dir(student_dir)
+        print('Fingerprint index: {} files added or refreshed'.format(added))
+        return added
+
+    # Ranks the indexed students from other terms by how many of student_dir's fingerprints they share
+    def query(self, student_dir: pathlib.Path, exclude_term: str = None, limit: int = 5) -> pd.DataFrame:
+        hashes = list()
+        for file_path in sorted(student_dir.iterdir()):
+            if file_path.is_file():
+                tokens, _ = tokenize(file_path.read_text(encoding='utf-8', errors='replace'))
+                hashes.append(fingerprint(tokens)[0])
+        hashes = np.unique(np.concatenate(hashes)).view(np.int64) if len(hashes) > 0 else np.empty(0, np.int64)
+
+        columns = ['course', 'term', 'assignment', 'ta', 'student', 'shared', 'percent']
+        if len(hashes) == 0:
+            return pd.DataFrame(columns=columns)
+
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER PRIMARY KEY)')
+        self.db.execute('DELETE FROM query')
+        self.db.executemany('INSERT INTO query VALUES (?)', [(int(h),) for h in hashes])
+        rows = self.db.execute('SELECT d.course, d.term, d.assignment, d.ta, d.student, '
+                               'COUNT(DISTINCT f.hash) AS shared '
+                               'FROM query q JOIN fingerprints f ON f.hash = q.hash JOIN docs d ON d.id = f.doc '
+                               'WHERE d.term IS NOT ? GROUP BY d.course, d.term, d.assignment, d.ta, d.student '
+                               'ORDER BY shared DESC LIMIT ?', (exclude_term, limit)).fetchall()
+
+        matches = pd.DataFrame(rows, columns=columns[:-1])
+        matches['percent'] = (100 * matches['shared'] / len(hashes)).astype(int)
+        return matches
+
+    def close(self) -> None:
+        self.db.close()
+        return
+
+
+def check_prior_terms(course_dir: pathlib.Path, term: str, assignments_list: list = None,
+                      min_percent: int = 50, index: FingerprintIndex = None) -> pd.DataFrame:
+    """
+    Checks every student downloaded in term against the submissions of all other terms in the index,
+    earlier offerings of the same course included. Matches at or above min_percent are saved to
+    plagiarism/prior_terms.xlsx.
+    """
+    own_index = index is None
+    if own_index:
+        index = FingerprintIndex(course_dir.parent / '.fingerprints.sqlite')
+
+    try:
+        # Pick up any trees downloaded before the index existed, their term is unknown
+        index.backfill(course_dir.parent)
+
+        records = list()
+        for assignment, ta, student in index.get_term_students(course_dir.name, term):
+            if assignments_list is not None and assignment not in assignments_list:
+                continue
+            student_dir = course_dir / 'assignments' / assignment / ta / student
+            if not student_dir.is_dir():
+                continue
+
+            for _, match in index.query(student_dir, exclude_term=term).iterrows():
+                if match['percent'] < min_percent:
+                    continue
+                records.append({
+                    'PA': assignment, 'TA': ta, 'student': student,
+                    'prior course': match['course'], 'prior term': match['term'] or 'unknown',
+                    'prior PA': match['assignment'], 'prior TA': match['ta'],
+                    'prior student': match['student'], 'percent_same': match['percent']
+                })
+    finally:
+        if own_index:
+            index.close()
+
+    results = pd.DataFrame(records, columns=['PA', 'TA', 'student', 'prior course', 'prior term', 'prior PA',
+                                             'prior TA', 'prior student', 'percent_same'])
+
+    (course_dir / 'plagiarism').mkdir(exist_ok=True, parents=True)
+    results.to_excel(course_dir / 'plagiarism' / 'prior_terms.xlsx', index=False)
+    print('Prior term matches for {}: {}'.format(term, len(results)))
+
+    return results
@@ -10,6 +10,7 @@ class GuiWindow(tk.Tk):
         self.title(title)
         self.geometry(window_size)
         self.progressbar = None
+        self.progress_label = None
         return
 
     # Gets user entry based on number of prompts sent
@@ -64,12 +65,16 @@ class GuiWindow(tk.Tk):
         button.pack()
 
         button_texts = ["Create Gradebook", "Download Submissions", "Run MOSS",
-                        "Generate Cheating SpreadSheet",
-                        "Generate Grading Status", "Generate Late Status", "Switch Course",
+                        "Generate Cheating SpreadSheet", "Generate Cheating SpreadSheet (Offline)",
+                        "Check Prior Terms",
+                        "Generate Grading Status", "Generate Late Status", "Toggle Full Resolution Plots",
+                        "Switch Course",
                         "Exit"]
         button_values = ["create_gradebook", "download_submissions", "run_moss",
-                         "generate_cheating_spreadsheet",
-                         "grading_status", "late_status", "switch_course",
+                         "generate_cheating_spreadsheet", "generate_cheating_spreadsheet_offline",
+                         "check_prior_terms",
+                         "grading_status", "late_status", "toggle_resolution",
+                         "switch_course",
                          "exit"]
 
         for ind in range(len(button_texts)):
@@ -106,15 +111,20 @@ class GuiWindow(tk.Tk):
         self._clear_window()
         return selection
 
-    def set_progress_bar(self, step: float, reset: bool = False) -> None:
+    def set_progress_bar(self, step: float, reset: bool = False, text: str = None) -> None:
         if self.progressbar is None:
             self.progressbar = ttk.Progressbar(orient=tk.HORIZONTAL, length=420)
             self.progressbar.pack()
+            self.progress_label = tk.Label(self, text='')
+            self.progress_label.pack()
         if reset:
             self._clear_window()
             self.progressbar = None
+            self.progress_label = None
         else:
             self.progressbar.step(step)
+            if text is not None:
+                self.progress_label.config(text=text)
         self.update_idletasks()
         return
 
@@ -1,16 +1,16 @@
-import pickle
 import hashlib
 import pathlib
+import sqlite3
 
-from os.path import isfile, join, isdir
+from os.path import isfile, isdir
 
 
 class SavedRuns:
 
-    def __init__(self, file_name: str) -> None:
-        self.runs_file = '.saved_runs.pkl'
+    def __init__(self, file_name: str, runs_file: str = '.saved_runs.sqlite') -> None:
+        self.runs_file = runs_file
         self.file_name = file_name
-        self.saved_runs = None
+        self.db = None
         self.file_hash = None
         return
 
@@ -18,75 +18,88 @@ class SavedRuns:
     def check_hash(self) -> bool:
         # Generate hash if not yet computed
         if self.file_hash is None:
-            self.file_hash = self.get_md5()
-
-        # Create empty dict if it failed to load
-        if self.saved_runs is None:
-            self.load_saved_runs()
-
-        # Check for any saved runs
-        if self.saved_runs is None:
-            return False
+            self.file_hash = self.get_digest()
 
         # Check for file_name in saved runs
-        if self.file_name not in self.saved_runs:
+        row = self.connect().execute('SELECT digest FROM runs WHERE name = ?', (str(self.file_name),)).fetchone()
+        if row is None:
             return False
 
         # Check hash is same as last
-        if self.saved_runs[self.file_name] != self.file_hash:
-            return False
-
-        return True
-
-    # Loads dictionary of saved runes from file
-    def load_saved_runs(self) -> None:
-        try:
-            with open(self.runs_file, 'rb') as f:
-                self.saved_runs = pickle.load(f)
-        except FileNotFoundError as e:
-            self.saved_runs = dict()
-        return
-
-    # Saves dictionary of saved runes from file
-    def save_saved_runs(self) -> None:
-        with open(self.runs_file, 'wb') as f:
-            pickle.dump(self.saved_runs, f)
-        return
-
-    # Generates the MD5SUM of a file / dir
-    def get_md5(self) -> str:
-        # hash object
-        hash_md5 = hashlib.md5()
-
-        # When file name is a file
+        return row[0] == self.file_hash
+
+    # Opens the manifest, one row per saved run and one per file hashed so far
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.runs_file)
+            self.db.execute('CREATE TABLE IF NOT EXISTS runs (name TEXT PRIMARY KEY, digest TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, '
+                            'mtime_ns INTEGER, digest TEXT)')
+            self.db.commit()
+        return self.db
+
+    # Generates the digest of a file / dir, directories are a Merkle combination of their children
+    def get_digest(self) -> str:
         if isfile(self.file_name):
-            with open(self.file_name, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-
-        # When file name is a directory, recurse through all files
+            digest = self.get_file_digest(pathlib.Path(self.file_name))
         elif isdir(self.file_name):
-            for path in pathlib.Path(self.file_name).rglob('*.'):
-                with open(path, "rb") as f:
-                    for chunk in iter(lambda: f.read(4096), b""):
-                        hash_md5.update(chunk)
-
-        return hash_md5.hexdigest()
+            digest = self.get_dir_digest(pathlib.Path(self.file_name))
+        else:
+            digest = hashlib.blake2b(digest_size=20).hexdigest()
+
+        # Save any newly hashed files in one go
+        self.connect().commit()
+        return digest
+
+    # Hashes a file, unless its size and mtime match the manifest
+    def get_file_digest(self, path: pathlib.Path) -> str:
+        stat = path.stat()
+        key = str(path.resolve())
+        row = self.connect().execute('SELECT size, mtime_ns, digest FROM files WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = hash_file(path)
+        self.connect().execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                               (key, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    # Combines the names and digests of a directory's children in a stable order
+    def get_dir_digest(self, path: pathlib.Path) -> str:
+        hash_blake = hashlib.blake2b(digest_size=20)
+        for child in sorted(path.iterdir()):
+            if child.is_dir():
+                kind, digest = 'd', self.get_dir_digest(child)
+            elif child.is_file():
+                kind, digest = 'f', self.get_file_digest(child)
+            else:
+                continue
+            hash_blake.update('{}\0{}\0{}\n'.format(kind, child.name, digest).encode())
+        return hash_blake.hexdigest()
 
     # Save current file_name / hash pairing to file
     def save_hash(self) -> None:
         # Generate hash if not yet computed
         if self.file_hash is None:
-            self.file_hash = self.get_md5()
+            self.file_hash = self.get_digest()
 
-        # Create empty dict if it failed to load
-        if self.saved_runs is None:
-            self.load_saved_runs()
+        # Update just this run's row
+        self.connect().execute('INSERT OR REPLACE INTO runs VALUES (?, ?)', (str(self.file_name), self.file_hash))
+        self.connect().commit()
 
-        # Update hashed results
-        self.saved_runs[self.file_name] = self.file_hash
-
-        # Save to file
-        self.save_saved_runs()
+        return
 
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
         return
+
+
+# Fast content hash of a single file, read in 1 MB chunks
+def hash_file(path) -> str:
+    hash_blake = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_blake.update(chunk)
+    return hash_blake.hexdigest()
@@ -0,0 +1,291 @@
+import functools
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# Run reports are written under <course>/metrics/
+METRICS_DIR = 'metrics'
+
+# Prefix of every exported Prometheus series
+PROMETHEUS_PREFIX = 'canvas_lab'
+
+# Help text of the counters the pipeline records
+COUNTER_HELP = {
+    'attachments': 'Submission attachments, by where they were taken from.',
+    'bytes_archived': 'Bytes of MOSS pages archived.',
+    'bytes_downloaded': 'Bytes of attachments downloaded from canvas.',
+    'bytes_extracted': 'Bytes of source kept from submissions.',
+    'figures': 'Report figures, by whether they were rendered.',
+    'files': 'Submission files, by whether they were kept.',
+    'moss_attempts': 'MOSS submission attempts.',
+    'moss_files_submitted': 'Files submitted to MOSS.',
+    'moss_jobs': 'MOSS jobs, by final status.'
+}
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus layout, bucket counts include every smaller bucket.
+    """
+
+    def __init__(self, buckets: list = None) -> None:
+        self.buckets = buckets or LATENCY_BUCKETS
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        return
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        return
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}}
+
+
+class RunMetrics:
+    """
+    Everything measured during one run, stage timings, counters and per endpoint request latencies.
+    Safe to update from the download and section threads.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+        return
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time.time()
+            self.stages = dict()
+            self.counters = dict()
+            self.requests = dict()
+            self.cached = dict()
+        return
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the enclosed block as one call of the stage, wall clock and the calling thread's cpu,
+        so stages running at once on other threads do not count each other's work.
+        """
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - wall, time.thread_time() - cpu)
+        return
+
+    # Adds time measured elsewhere, e.g. returned by a worker process, to a stage
+    def record_stage(self, name: str, seconds: float, cpu_seconds: float = 0.0, calls: int = 1) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['calls'] += calls
+            stage['seconds'] += seconds
+            stage['cpu_seconds'] += cpu_seconds
+        return
+
+    def add(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+    def observe_request(self, service: str, endpoint: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.requests.setdefault((service, endpoint), Histogram())
+            histogram.observe(seconds)
+        return
+
+    def count_cached(self, service: str, endpoint: str) -> None:
+        with self.lock:
+            self.cached[(service, endpoint)] = self.cached.get((service, endpoint), 0) + 1
+        return
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'seconds': round(time.time() - self.started, 3),
+                'stages': {name: {'calls': stage['calls'], 'seconds': round(stage['seconds'], 4),
+                                  'cpu_seconds': round(stage['cpu_seconds'], 4)}
+                           for name, stage in sorted(self.stages.items())},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'requests': [dict(histogram.to_dict(), service=service, endpoint=endpoint,
+                                  cached=self.cached.get((service, endpoint), 0))
+                             for (service, endpoint), histogram in sorted(self.requests.items())] +
+                            [{'service': service, 'endpoint': endpoint, 'count': 0, 'cached': cached}
+                             for (service, endpoint), cached in sorted(self.cached.items())
+                             if (service, endpoint) not in self.requests]
+            }
+
+    def to_prometheus(self, const_labels: dict = None) -> str:
+        """
+        Renders the run in the Prometheus text exposition format, for a node_exporter textfile collector.
+        """
+        const_labels = const_labels or dict()
+        lines = list()
+
+        def metric(name: str, kind: str, help_text: str) -> str:
+            full_name = '{}_{}'.format(PROMETHEUS_PREFIX, name)
+            lines.append('# HELP {} {}'.format(full_name, help_text))
+            lines.append('# TYPE {} {}'.format(full_name, kind))
+            return full_name
+
+        def sample(name: str, labels: dict, value: float) -> None:
+            lines.append('{}{} {}'.format(name, format_labels(dict(const_labels, **labels)), format_value(value)))
+            return
+
+        with self.lock:
+            name = metric('run_timestamp_seconds', 'gauge', 'Unix time the run started.')
+            sample(name, dict(), self.started)
+            name = metric('run_seconds', 'gauge', 'Wall clock length of the run.')
+            sample(name, dict(), time.time() - self.started)
+
+            for field, help_text in [('calls', 'Times the stage ran.'),
+                                     ('seconds', 'Wall clock seconds spent in the stage.'),
+                                     ('cpu_seconds', 'Cpu seconds spent in the stage.')]:
+                name = metric('stage_' + field, 'gauge', help_text)
+                for stage_name, stage in sorted(self.stages.items()):
+                    sample(name, {'stage': stage_name}, stage[field])
+
+            for counter_name in sorted({name for name, _ in self.counters}):
+                name = metric(counter_name, 'gauge', COUNTER_HELP.get(counter_name, counter_name.replace('_', ' ')))
+                for (key_name, labels), value in sorted(self.counters.items()):
+                    if key_name == counter_name:
+                        sample(name, dict(labels), value)
+
+            name = metric('request_seconds', 'histogram', 'Latency of HTTP requests that reached the network.')
+            for (service, endpoint), histogram in sorted(self.requests.items()):
+                labels = {'service': service, 'endpoint': endpoint}
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    sample(name + '_bucket', dict(labels, le=format_value(bound)), count)
+                sample(name + '_bucket', dict(labels, le='+Inf'), histogram.count)
+                sample(name + '_sum', labels, histogram.sum)
+                sample(name + '_count', labels, histogram.count)
+
+            name = metric('requests_cached', 'gauge', 'HTTP requests answered from the on-disk cache.')
+            for (service, endpoint), cached in sorted(self.cached.items()):
+                sample(name, {'service': service, 'endpoint': endpoint}, cached)
+
+        return '\n'.join(lines) + '\n'
+
+
+# Process wide metrics of the current run
+_metrics = RunMetrics()
+
+
+def get_metrics() -> RunMetrics:
+    return _metrics
+
+
+def stage(name: str):
+    """
+    Shorthand for get_metrics().stage(name).
+    """
+    return _metrics.stage(name)
+
+
+def timed(name: str):
+    """
+    Decorator that times every call of the function as the named stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items())]
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def get_endpoint(url: str) -> str:
+    """
+    Groups request urls by endpoint, numeric path segments become :id and the query is dropped.
+    """
+    return re.sub(r'/\d+(?=/|$)', '/:id', urlparse(url).path) or '/'
+
+
+class RequestCounter:
+    """
+    Response hook that counts HTTP round trips, in total and for the calling thread,
+    and records each one's latency under its endpoint in the run metrics.
+    """
+
+    def __init__(self, service: str = 'canvas'):
+        self.service = service
+        self.total = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        return
+
+    def __call__(self, response, *args, **kwargs):
+        endpoint = get_endpoint(response.url)
+
+        # Responses served from the on-disk cache never touched the network
+        if getattr(response, 'from_cache', False):
+            _metrics.count_cached(self.service, endpoint)
+            return response
+
+        with self.lock:
+            self.total += 1
+        self.local.count = self.thread_count() + 1
+        _metrics.observe_request(self.service, endpoint, response.elapsed.total_seconds())
+        return response
+
+    def thread_count(self) -> int:
+        return getattr(self.local, 'count', 0)
+
+
+def write_run_report(course_dir: pathlib.Path, actions: list = None, reset: bool = True) -> tuple:
+    """
+    Writes the run as metrics/run-<time>.json, kept for every run, and metrics/<prefix>.prom,
+    replaced by every run. Starts a fresh run unless reset is False. Returns both paths.
+    """
+    metrics_dir = course_dir / METRICS_DIR
+    metrics_dir.mkdir(exist_ok=True, parents=True)
+
+    report = dict(_metrics.to_dict(), course=course_dir.name, actions=actions or list())
+    json_path = metrics_dir / 'run-{}.json'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(_metrics.started)))
+    json_path.write_text(json.dumps(report, indent=2))
+
+    # Written atomically, the textfile collector may read it at any moment
+    prom_path = metrics_dir / (PROMETHEUS_PREFIX + '.prom')
+    tmp_path = prom_path.with_name('.' + prom_path.name)
+    tmp_path.write_text(_metrics.to_prometheus({'course': course_dir.name}))
+    os.replace(tmp_path, prom_path)
+
+    if reset:
+        _metrics.reset()
+    return json_path, prom_path
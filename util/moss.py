@@ -1,13 +1,203 @@
+import hashlib
 import pathlib
 import pandas as pd
+import re
+import socket
 import stat
-import subprocess
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 
-def run_moss(course_dir: pathlib.Path, assignments_list: list, language: str = 'cc') -> None:
-    generate_moss(course_dir, assignments_list, language)
-    subprocess.call(['sh', str((course_dir / 'run_moss.sh').relative_to('.'))])
-    return
+from util.hashing import SavedRuns
+from util.metrics import get_metrics, stage, timed
+
+
+MOSS_HOST = 'moss.stanford.edu'
+MOSS_PORT = 7690
+
+
+class MossJob:
+    """
+    One assignment's MOSS submission and its progress through the scheduler.
+    """
+
+    def __init__(self, assignment: str, files: list) -> None:
+        self.assignment = assignment
+        self.files = files
+        self.status = 'pending'
+        self.attempts = 0
+        self.url = None
+        self.error = None
+        self.saved_run = None
+        return
+
+
+@timed('run_moss')
+def run_moss(course_dir: pathlib.Path, assignments_list: list, language: str = 'cc', max_jobs: int = 4,
+             retries: int = 3, backoff: float = 5.0, host: str = MOSS_HOST, port: int = MOSS_PORT,
+             user_id: str = None, force: bool = False) -> dict:
+    """
+    Submits one MOSS job per assignment, up to max_jobs at a time, retrying failures with backoff.
+    Each result url is written to moss_output/<PA>.txt as soon as its job finishes.
+    Assignments whose submitted files are unchanged since their last successful run are skipped,
+    unless force is set, and rerun assignments have their saved plagiarism/<PA>.html dropped.
+    """
+    if user_id is None:
+        user_id = get_moss_user_id(pathlib.Path(__file__).parent.parent / 'moss')
+
+    moss_output_path = course_dir / 'moss_output'
+    moss_output_path.mkdir(exist_ok=True, parents=True)
+
+    jobs = {assignment: MossJob(assignment, collect_moss_files(course_dir / 'assignments', assignment))
+            for assignment in assignments_list}
+
+    # Fingerprint each submission set, the last successful one is kept per assignment and language
+    runs_file = str(course_dir / '.saved_runs.sqlite')
+    for job in jobs.values():
+        job.saved_run = SavedRuns('moss:{}:{}'.format(job.assignment, language), runs_file=runs_file)
+        job.saved_run.file_hash = get_submission_digest(job.saved_run, job.files, language)
+        if force or not job.saved_run.check_hash() or not (moss_output_path / (job.assignment + '.txt')).is_file():
+            continue
+        job.status = 'skipped'
+        job.url = (moss_output_path / (job.assignment + '.txt')).read_text().strip()
+        print('MOSS {}: unchanged since last run, reusing {}'.format(job.assignment, job.url))
+
+    def run_job(job: MossJob) -> MossJob:
+        if job.status == 'skipped':
+            return job
+        if len(job.files) == 0:
+            job.status = 'failed'
+            print('MOSS {}: no downloaded files to submit'.format(job.assignment))
+            return job
+
+        comment = '{} in {}'.format(job.assignment, course_dir.name)
+        while job.status != 'done':
+            job.status = 'running'
+            job.attempts += 1
+            try:
+                with stage('submit_moss'):
+                    job.url = submit_moss(job.files, user_id, language, comment, host=host, port=port)
+                job.status = 'done'
+            except (OSError, ValueError) as e:
+                job.error = e
+                if job.attempts > retries:
+                    job.status = 'failed'
+                    print('MOSS {}: failed after {} attempts: {}'.format(job.assignment, job.attempts, e))
+                    return job
+                print('MOSS {}: attempt {} failed ({}), retrying'.format(job.assignment, job.attempts, e))
+                time.sleep(backoff * 2 ** (job.attempts - 1))
+
+        with open(moss_output_path / (job.assignment + '.txt'), 'w') as f_out:
+            f_out.write(job.url + '\n')
+
+        # The saved results page belongs to the previous run
+        (course_dir / 'plagiarism' / (job.assignment + '.html')).unlink(missing_ok=True)
+
+        print('MOSS {}: {}'.format(job.assignment, job.url))
+        return job
+
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        list(executor.map(run_job, jobs.values()))
+
+    # Only successful runs are remembered, so failed ones are retried next time
+    for job in jobs.values():
+        if job.status == 'done':
+            job.saved_run.save_hash()
+            get_metrics().add('moss_files_submitted', len(job.files))
+        job.saved_run.close()
+        get_metrics().add('moss_jobs', status=job.status)
+        get_metrics().add('moss_attempts', job.attempts)
+
+    print('=' * 40)
+    print('MOSS: {} done, {} skipped, {} failed'.format(sum(job.status == 'done' for job in jobs.values()),
+                                                        sum(job.status == 'skipped' for job in jobs.values()),
+                                                        sum(job.status == 'failed' for job in jobs.values())))
+    print('=' * 40)
+    return jobs
+
+
+def get_moss_user_id(moss_path: pathlib.Path) -> str:
+    """
+    Reads the user id out of the moss script mailed out by Stanford.
+    """
+    match = re.search(r'\$userid\s*=\s*(\d+)', moss_path.read_text())
+    if match is None:
+        raise ValueError('No $userid found in {}'.format(moss_path))
+    return match.group(1)
+
+
+def collect_moss_files(class_code: pathlib.Path, assignment: str) -> list:
+    """
+    Lists the files to submit for an assignment, the first file of each extension per student.
+    """
+    files = list()
+
+    # Track unique file extensions per student
+    extensions = {}
+
+    for code_file in sorted((class_code / assignment).glob('**/*')):
+        if code_file.is_dir():
+            continue
+
+        student_name = code_file.parent.name
+        extension = code_file.suffix
+
+        if student_name not in extensions:
+            extensions[student_name] = set()
+
+        if extension not in extensions[student_name]:
+            extensions[student_name].add(extension)
+            files.append(code_file.resolve())
+
+    return files
+
+
+def get_submission_digest(saved_run: SavedRuns, files: list, language: str) -> str:
+    """
+    Digest of everything a MOSS job depends on, the language and each submitted file's path and content.
+    File digests come from the saved runs manifest, so unchanged files are not read again.
+    """
+    hash_blake = hashlib.blake2b(digest_size=20)
+    hash_blake.update('{}\n'.format(language).encode())
+    for path in files:
+        hash_blake.update('{}\0{}\n'.format(path, saved_run.get_file_digest(pathlib.Path(path))).encode())
+    saved_run.connect().commit()
+    return hash_blake.hexdigest()
+
+
+def submit_moss(files: list, user_id: str, language: str, comment: str, host: str = MOSS_HOST,
+                port: int = MOSS_PORT, max_matches: int = 1000000, show: int = 250, timeout: float = 600) -> str:
+    """
+    Speaks the MOSS protocol directly, in directory mode, and returns the results url.
+    """
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        responses = sock.makefile('rb')
+
+        sock.sendall('moss {}\n'.format(user_id).encode())
+        sock.sendall(b'directory 1\n')
+        sock.sendall(b'X 0\n')
+        sock.sendall('maxmatches {}\n'.format(max_matches).encode())
+        sock.sendall('show {}\n'.format(show).encode())
+        sock.sendall('language {}\n'.format(language).encode())
+        response = responses.readline().strip()
+        if response == b'':
+            raise ConnectionError('MOSS closed the connection')
+        if response != b'yes':
+            raise ValueError('MOSS does not support language {}'.format(language))
+
+        for file_id, path in enumerate(files, start=1):
+            content = pathlib.Path(path).read_bytes()
+            name = re.sub(r'\s', '_', str(path))
+            sock.sendall('file {} {} {} {}\n'.format(file_id, language, len(content), name).encode())
+            sock.sendall(content)
+
+        sock.sendall('query 0 {}\n'.format(comment).encode())
+        url = responses.readline().decode().strip()
+        sock.sendall(b'end\n')
+
+    if not url.startswith('http'):
+        raise ValueError('MOSS returned no results url: {}'.format(url))
+    return url
 
 
 def generate_moss(course_dir: pathlib.Path, assignments_list: list, language: str = 'cc') -> None:
@@ -34,27 +224,8 @@ def generate_moss(course_dir: pathlib.Path, assignments_list: list, language: st
             f_out.write(f'-c "{assignment_safe} in {course_name_safe}" ')
 
             # **Get all C files for the assignment (absolute paths)**
-            code_files = (class_code / assignment).glob('**/*')
-
-            # Track unique file extensions per student
-            extensions = {}
-
-            for code_file in code_files:
-                if code_file.is_dir():
-                    continue
-
-                student_name = code_file.parent.name
-                extension = code_file.suffix
-
-                if student_name not in extensions:
-                    extensions[student_name] = set()
-
-                if extension not in extensions[student_name]:
-                    extensions[student_name].add(extension)
-
-                    # **Use absolute paths for student submission files**
-                    abs_code_file = code_file.resolve()  # Get absolute path
-                    f_out.write(f'"{abs_code_file}" ')
+            for abs_code_file in collect_moss_files(class_code, assignment):
+                f_out.write(f'"{abs_code_file}" ')
 
             # **Save results to a text file (absolute path)**
             moss_output_file = (moss_output_path / (assignment + '.txt')).resolve()
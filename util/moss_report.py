@@ -0,0 +1,269 @@
+import gzip
+import os
+import pathlib
+import re
+import threading
+
+import pandas as pd
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlparse
+
+from util.hashing import hash_file
+from util.metrics import RequestCounter, get_metrics
+
+
+# Columns of one assignment's results, in the order get_results has always produced them
+RESULT_COLUMNS = ['PA', 'TA 1', 'TA 2', 'student 1', 'student 2', 'percent_1', 'percent_2', 'lines_matched', 'url']
+
+# Parsed reports are cached next to the html, one feather file per report version
+PARSED_DIR = '.parsed'
+
+CHUNK_BYTES = 64 * 1024
+
+# Match pages are framesets, their frames are archived alongside them
+FRAME_SRC = re.compile(rb'<frame[^>]*\ssrc="?([^"\s>]+)', re.IGNORECASE)
+
+
+class MossResultsParser(HTMLParser):
+    """
+    Streams a MOSS results page and collects the rows of its match table.
+    Each row is two linked file names with their percentages, then the lines matched.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.rows = list()
+        self.in_table = False
+        self.cells = None
+        self.cell = None
+        return
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag == 'table':
+            self.in_table = True
+        elif not self.in_table:
+            return
+        elif tag == 'tr':
+            self._end_row()
+            self.cells = list()
+        elif tag == 'td' and self.cells is not None:
+            self._end_cell()
+            self.cell = {'text': '', 'href': None}
+        elif tag == 'a' and self.cell is not None:
+            self.cell['href'] = dict(attrs).get('href')
+        return
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == 'table':
+            self._end_row()
+            self.in_table = False
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'td':
+            self._end_cell()
+        return
+
+    def handle_data(self, data: str) -> None:
+        if self.cell is not None:
+            self.cell['text'] += data
+        return
+
+    # Cells are often left unclosed, so a cell ends at the next cell or row
+    def _end_cell(self) -> None:
+        if self.cell is not None:
+            self.cells.append(self.cell)
+            self.cell = None
+        return
+
+    def _end_row(self) -> None:
+        self._end_cell()
+        if self.cells is not None and len(self.cells) == 3 and self.cells[0]['href'] is not None:
+            self.rows.append(self.cells)
+        self.cells = None
+        return
+
+
+def split_match_name(text: str) -> tuple:
+    """
+    Splits '<path>/PA/TA/student/ (95%)' into the TA, student and percent.
+    """
+    name, _, percent = text.strip().rpartition(' (')
+
+    path_parts = pathlib.Path(name).parts
+    if len(path_parts) >= 2:
+        ta, student = path_parts[-2], path_parts[-1]
+    else:
+        ta, student = 'UNKNOWN_TA', 'UNKNOWN_STUDENT'
+    return ta, student, int(percent.rstrip('%)'))
+
+
+def parse_moss_report(html_path: pathlib.Path) -> pd.DataFrame:
+    """
+    Parses a saved MOSS results page into one record per matched pair.
+    """
+    parser = MossResultsParser()
+    with open(html_path, encoding='utf-8', errors='replace') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_BYTES), ''):
+            parser.feed(chunk)
+    parser.close()
+
+    records = list()
+    for first, second, lines in parser.rows:
+        ta_1, student_1, percent_1 = split_match_name(first['text'])
+        ta_2, student_2, percent_2 = split_match_name(second['text'])
+        records.append({
+            'PA': html_path.stem,
+            'TA 1': ta_1, 'TA 2': ta_2,
+            'student 1': student_1, 'student 2': student_2,
+            'percent_1': percent_1, 'percent_2': percent_2,
+            'lines_matched': int(lines['text'].strip()), 'url': first['href']
+        })
+
+    return pd.DataFrame(records, columns=RESULT_COLUMNS)
+
+
+def load_moss_report(html_path: pathlib.Path) -> pd.DataFrame:
+    """
+    Returns the parsed report, from the feather cache when this exact html was parsed before.
+    """
+    parsed_dir = html_path.parent / PARSED_DIR
+    parsed_path = parsed_dir / '{}-{}.feather'.format(html_path.stem, hash_file(html_path))
+    if parsed_path.is_file():
+        return pd.read_feather(parsed_path)
+
+    results = parse_moss_report(html_path)
+
+    # Drop the parse of any earlier version of this report
+    parsed_dir.mkdir(exist_ok=True)
+    for old_path in parsed_dir.glob('*.feather'):
+        if old_path.stem.rpartition('-')[0] == html_path.stem:
+            old_path.unlink()
+    results.to_feather(parsed_path)
+
+    return results
+
+
+def get_report_url(text_file: pathlib.Path) -> str:
+    """
+    Returns the results url from a moss_output/<PA>.txt, the last line naming one, or None.
+    """
+    url = None
+    for line in text_file.read_text().splitlines():
+        if 'http' in line:
+            url = line.strip()
+    return url
+
+
+def create_archive_session(pool_size: int = 8) -> requests.Session:
+    """
+    Session for fetching MOSS pages, with one pooled connection per archiving thread.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(RequestCounter('moss'))
+    return session
+
+
+def fetch_page(session: requests.Session, url: str, target: pathlib.Path) -> bytes:
+    """
+    Saves a page to target and returns its content.
+    Pages already on disk are read back instead of fetched again.
+    """
+    if target.is_file():
+        return target.read_bytes()
+
+    content = download_page(session, url)
+    save_page(target, content)
+    return content
+
+
+def download_page(session: requests.Session, url: str) -> bytes:
+    response = session.get(url, timeout=60)
+    response.raise_for_status()
+    get_metrics().add('bytes_archived', len(response.content))
+    return response.content
+
+
+# Written atomically, a page on disk is always complete
+def save_page(target: pathlib.Path, content: bytes) -> None:
+    target.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = target.with_name(target.name + '.tmp' + str(threading.get_ident()))
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, target)
+    return
+
+
+def fetch_archived_page(session: requests.Session, url: str, target: pathlib.Path) -> bytes:
+    """
+    Returns a page about to be archived at target. Earlier versions kept archived pages gzipped at
+    target.gz, such a copy is used and removed instead, MOSS may have deleted the page since.
+    """
+    gzip_path = target.with_name(target.name + '.gz')
+    if gzip_path.is_file():
+        return gzip.decompress(gzip_path.read_bytes())
+    return download_page(session, url)
+
+
+def archive_match(session: requests.Session, url: str, match_dir: pathlib.Path) -> pathlib.Path:
+    """
+    Archives one match page and its frames under their own names, with the frames pointed at each other
+    so the archived page opens in a browser. Returns the archived match page.
+    """
+    name = pathlib.PurePosixPath(urlparse(url).path).name
+    target = match_dir / name
+
+    # Written last, so an archived match page means its frames are there too
+    if target.is_file():
+        return target
+
+    content = fetch_archived_page(session, url, target)
+    frame_paths = list()
+    for src in FRAME_SRC.findall(content):
+        frame_url = urljoin(url, src.decode())
+        frame_path = match_dir / pathlib.PurePosixPath(urlparse(frame_url).path).name
+        if not frame_path.is_file():
+            save_page(frame_path, fetch_archived_page(session, frame_url, frame_path))
+        frame_paths.append(frame_path)
+
+    # Point the frames at the local copies
+    def local_frame(match) -> bytes:
+        frame_name = pathlib.PurePosixPath(urlparse(urljoin(url, match.group(1).decode())).path).name
+        return match.group(0)[:match.start(1) - match.start(0)] + frame_name.encode()
+
+    save_page(target, FRAME_SRC.sub(local_frame, content))
+
+    for path in [target] + frame_paths:
+        path.with_name(path.name + '.gz').unlink(missing_ok=True)
+    return target
+
+
+def archive_report(html_path: pathlib.Path, report_url: str, archive_dir: pathlib.Path,
+                   session: requests.Session, executor: ThreadPoolExecutor) -> dict:
+    """
+    Archives every match page linked from a saved report under archive_dir/<PA>/<report id>/.
+    Returns the remote url of each archived match mapped to its path relative to the report's directory.
+    """
+    report_id = re.sub(r'\W', '_', urlparse(report_url).path.strip('/'))
+    match_dir = archive_dir / html_path.stem / report_id
+
+    futures = dict()
+    for url in load_moss_report(html_path)['url'].unique():
+        futures[url] = executor.submit(archive_match, session, url, match_dir)
+
+    archived = dict()
+    failed = 0
+    for url, future in futures.items():
+        try:
+            archived[url] = future.result().relative_to(html_path.parent).as_posix()
+        except (requests.RequestException, OSError) as e:
+            print('Failed to archive {}: {}'.format(url, e))
+            failed += 1
+
+    print('Archived {}: {} match pages, {} failed'.format(html_path.stem, len(archived), failed))
+    return archived
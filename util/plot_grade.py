@@ -1,17 +1,18 @@
-import pandas as pd
 import pathlib
-import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 
+from util.render import FigureTask, render_figures
+from util.store import load_frame
 
-def plot_grade(course_dir: pathlib.Path, list_of_assignments: list) -> None:
+
+def plot_grade(course_dir: pathlib.Path, list_of_assignments: list, preview: bool = False) -> None:
     # Load TA list
-    ta_list = pd.read_excel(course_dir / 'ta_list.xlsx')
+    ta_list = load_frame(course_dir, 'ta_list')
 
     # Clear, Load, Subset df based on assignments and section name
     df = None
-    df = pd.read_excel(course_dir / 'grade_book.xlsx')
+    df = load_frame(course_dir, 'grade_book')
     df = df[['Section'] + list_of_assignments]
 
     # If the TA has graded nothing in a column, but students still have zeros given (lates)
@@ -27,11 +28,19 @@ def plot_grade(course_dir: pathlib.Path, list_of_assignments: list) -> None:
     df = df.iloc[:, 1:]
 
     # Plot as heatmap
-    sns.heatmap(df, xticklabels=df.columns, yticklabels=ta_list['Name'].tolist(), cmap='mako')
-    plt.ylabel('')
-    plt.title(course_dir.name + ' - %graded')
-    plt.tight_layout()
-    plt.savefig(course_dir / 'percent_graded.png', dpi=300)
-    plt.clf()
+    render_figures([FigureTask(course_dir / 'percent_graded.png', draw_grade,
+                               {'percent_graded': df, 'tas': ta_list['Name'].tolist(),
+                                'title': course_dir.name + ' - %graded'}, dpi=300)],
+                   course_dir / '.saved_runs.sqlite', preview=preview)
+
+    return
+
 
+def draw_grade(fig, data: dict) -> None:
+    ax = fig.subplots()
+    sns.heatmap(data['percent_graded'], xticklabels=data['percent_graded'].columns, yticklabels=data['tas'],
+                cmap='mako', ax=ax)
+    ax.set_ylabel('')
+    ax.set_title(data['title'])
+    fig.tight_layout()
     return
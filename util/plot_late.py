@@ -1,33 +1,57 @@
 import pandas as pd
 import pathlib
-import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 
+from util.render import FigureTask, render_figures
+from util.store import load_frame
 
-def plot_late(course_dir: pathlib.Path, list_of_assignments: list) -> None:
+
+def plot_late(course_dir: pathlib.Path, list_of_assignments: list, preview: bool = False) -> None:
     # Load TA list
-    ta_list = pd.read_excel(course_dir / 'ta_list.xlsx')
+    ta_list = load_frame(course_dir, 'ta_list')
 
     # Clear, Load, Subset df based on assignments and section name
     df = None
-    df = pd.read_excel(course_dir / 'grade_book_late.xlsx')
-
-    # Compute number of days late assignments
-    data = dict()
-    for index, row in df.iterrows():
-        for assignment in list_of_assignments:
-            ta_name = ta_list[ta_list['Section'] == row['Section']]['Name'].values[0]
-            if ta_name not in data:
-                data[ta_name] = [0] * 15
-
-            weeks_late = row[assignment+'-Late'] / (60*60*24*7)
-            if row[assignment] != 0 and weeks_late > 1:
-                data[ta_name][int(weeks_late)] += 1
-
-    data = pd.DataFrame(data).T
-    sns.heatmap(data, cmap='mako_r')
-    plt.title(course_dir.name + ' weeks late acceptance')
-    plt.tight_layout()
-    plt.savefig(course_dir / 'late_status.png', dpi=400)
+    df = load_frame(course_dir, 'grade_book_late')
+
+    # Compute number of weeks late assignments
+    data = late_histogram(df, ta_list, list_of_assignments)
+
+    render_figures([FigureTask(course_dir / 'late_status.png', draw_late,
+                               {'weeks_late': data, 'title': course_dir.name + ' weeks late acceptance'}, dpi=400)],
+                   course_dir / '.saved_runs.sqlite', preview=preview)
+    return
+
+
+def draw_late(fig, data: dict) -> None:
+    ax = fig.subplots()
+    sns.heatmap(data['weeks_late'], cmap='mako_r', ax=ax)
+    ax.set_title(data['title'])
+    fig.tight_layout()
     return
+
+
+def late_histogram(df: pd.DataFrame, ta_list: pd.DataFrame, list_of_assignments: list) -> pd.DataFrame:
+    """
+    Counts accepted submissions more than a week late, per TA (rows) and whole weeks late (columns).
+    """
+    # Map each student's section to its TA once
+    section_tas = ta_list.drop_duplicates('Section').set_index('Section')['Name']
+    ta_index, ta_names = pd.factorize(df['Section'].map(section_tas))
+
+    # Students x assignments grids of scores and weeks late
+    scores = df[list_of_assignments].to_numpy(dtype=float)
+    weeks_late = df[[assignment + '-Late' for assignment in list_of_assignments]].to_numpy(dtype=float)
+    weeks_late = weeks_late / (60*60*24*7)
+
+    # Late work that was still given a grade, in sections that have a TA
+    accepted = (scores != 0) & (weeks_late > 1) & (ta_index >= 0)[:, None]
+    rows = np.broadcast_to(ta_index[:, None], accepted.shape)[accepted]
+    weeks = weeks_late[accepted].astype(int)
+
+    # At least 15 week buckets, more when something is later than that
+    counts = np.zeros((len(ta_names), max(15, weeks.max(initial=0) + 1)), dtype=int)
+    np.add.at(counts, (rows, weeks), 1)
+
+    return pd.DataFrame(counts, index=ta_names)
@@ -1,244 +1,323 @@
-import pandas
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt
-import time
 import pathlib
-import seaborn as sns
-import urllib.request
+import requests
 
+import numpy as np
 import pandas as pd
-import networkx as nx
-import statistics
 
 from math import sqrt, ceil
+from concurrent.futures import ThreadPoolExecutor
+
+from util.moss_report import load_moss_report, get_report_url, create_archive_session, fetch_page, archive_report
+from util.metrics import timed
+from util.render import FigureTask, render_figures
+
+
+# Clusters drawn per assignment, the cluster table always lists them all
+MAX_CLUSTER_PLOTS = 36
+
+
+@timed('save_websites')
+def save_websites(moss_output: pathlib.Path, save_dir: pathlib.Path, workers: int = 8) -> dict:
+    """
+    Saves each assignment's moss results page, then archives every match page and its frames
+    under save_dir/archive, before MOSS expires them.
+    Returns, per assignment, each remote match url mapped to its local copy.
+    """
+    session = create_archive_session(workers)
+    archived = dict()
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        # Fetch missing results pages
+        reports = dict()
+        for text_file in sorted(moss_output.iterdir()):
+            url = get_report_url(text_file)
+            if url is None:
+                print('No moss url in {}'.format(text_file))
+                continue
 
-def save_websites(moss_output: pathlib.Path, save_dir: pathlib.Path) -> None:
-    # Load all text files
-    for text_file in moss_output.iterdir():
-        # Load text
-        moss_results = open(text_file.resolve(), 'r')
-        moss_lines = moss_results.read().split('\n')
-        print("moss results:")
-        print(moss_results)
-        # Get all urls
-        url = None
-        for line in moss_lines:
-            print('line:' + line)
-            if 'http' in line:
-                url = line
-
-        # Check if webpage already saved
-        if (save_dir / (text_file.stem + '.html')).is_file():
-            continue
-        else:
-            print('Saving: {pa} at {html}'.format(pa=text_file.stem, html=url))
-            urllib.request.urlretrieve(url, save_dir / (text_file.stem + '.html'))
-    return
+            html_path = save_dir / (text_file.stem + '.html')
+            if not html_path.is_file():
+                print('Saving: {pa} at {html}'.format(pa=text_file.stem, html=url))
+            reports[text_file.stem] = (url, html_path, executor.submit(fetch_page, session, url, html_path))
+
+        # Archive the match pages, already archived ones are kept as they are
+        for assignment, (url, html_path, future) in reports.items():
+            try:
+                future.result()
+            except requests.RequestException as e:
+                print('Failed to save {}: {}'.format(assignment, e))
+                continue
+            archived[assignment] = archive_report(html_path, url, save_dir / 'archive', session, executor)
+
+    session.close()
+    return archived
 
 
+@timed('get_results')
 def get_results(results_dir: pathlib.Path) -> dict:
     results = dict()
 
-    for assignment in results_dir.iterdir():
+    # Parse each saved moss page, unchanged pages come straight from the parsed cache
+    for assignment in sorted(results_dir.iterdir()):
         if '.html' not in assignment.name:
             continue
 
-        results[assignment.stem] = list()
-
-        with open(assignment) as fp:
-            soup = BeautifulSoup(fp, 'html.parser')
-
-        matched_lines = list()
-        for ind, lines in enumerate(soup.find_all('td')):
-            if ind % 3 == 2:
-                matched_lines.append(int(lines.contents[0][0:-1]))
-
-        links = list()
-        urls = list()
-        for link in soup.find_all('a')[6:]:
-            links.append(link.string)
-            urls.append(link['href'])
-
-        for ind in range(int(len(links) / 2)):
-            name_1 = links[ind*2].split(' ')[0]
-            name_2 = links[ind*2+1].split(' ')[0]
-
-            # **Fix: Extract TA & Student Names Correctly (Shift Right)**
-            path_parts_1 = pathlib.Path(name_1).parts
-            path_parts_2 = pathlib.Path(name_2).parts
+        results[assignment.stem] = load_moss_report(assignment)
 
-            # Extracting TA & student names (moving one more level right)
-            if len(path_parts_1) >= 2:
-                ta_1, student_1 = path_parts_1[-2], path_parts_1[-1]
-            else:
-                ta_1, student_1 = "UNKNOWN_TA", "UNKNOWN_STUDENT"
-
-            if len(path_parts_2) >= 2:
-                ta_2, student_2 = path_parts_2[-2], path_parts_2[-1]
-            else:
-                ta_2, student_2 = "UNKNOWN_TA", "UNKNOWN_STUDENT"
-
-            percent_1 = int(links[ind*2].split('%')[0].split('(')[1])
-            percent_2 = int(links[ind*2+1].split('%')[0].split('(')[1])
-            lines_shared = matched_lines[ind]
-            url = urls[ind*2]
+    return results
 
-            results[assignment.stem].append({
-                'PA': assignment.stem,
-                'TA 1': ta_1, 'TA 2': ta_2,
-                'student 1': student_1, 'student 2': student_2,
-                'percent_1': percent_1, 'percent_2': percent_2,
-                'lines_matched': lines_shared, 'url': url
-            })
 
-        results[assignment.stem] = pd.DataFrame(results[assignment.stem])
+@timed('plot_histograms')
+def plot_histograms(class_name: pathlib.Path, results: dict, preview: bool = False) -> None:
+    plots_dir = class_name / 'plots'
+    plots_dir.mkdir(exist_ok=True, parents=True)
 
-    return results
+    # Only the pair maxima are plotted
+    percent_same = {assignment: results[assignment][['percent_1', 'percent_2']].max(axis=1).reset_index(drop=True)
+                    for assignment in results}
 
+    render_figures([FigureTask(plots_dir / 'histogram.png', draw_histograms,
+                               {'percent_same': percent_same, 'title': class_name.parent.name}, dpi=1000)],
+                   class_name.parent / '.saved_runs.sqlite', preview=preview)
+    return None
 
 
-def plot_histograms(class_name: pathlib.Path, results: dict) -> None:
-    plots_dir = class_name / 'plots'
-    plots_dir.mkdir(exist_ok=True, parents=True)
+def draw_histograms(fig, data: dict) -> None:
+    percent_same = data['percent_same']
 
-    fig_size = ceil(sqrt(len(results.keys())))
-    fig, ax = plt.subplots(nrows=fig_size, ncols=fig_size)
+    fig_size = ceil(sqrt(len(percent_same.keys())))
+    ax = fig.subplots(nrows=fig_size, ncols=fig_size)
 
-    for a_ind, assignment in enumerate(sorted(results.keys())):
+    for a_ind, assignment in enumerate(sorted(percent_same.keys())):
         x = int(a_ind / fig_size)
         y = a_ind % fig_size
 
-        mean = results[assignment][['percent_1', 'percent_2']].max(axis=1).mean()
-        std = results[assignment][['percent_1', 'percent_2']].max(axis=1).std()
+        mean = percent_same[assignment].mean()
+        std = percent_same[assignment].std()
         if fig_size == 1:
-            ax.hist(results[assignment][['percent_1', 'percent_2']].max(axis=1), bins=20, range=(0, 100))
+            ax.hist(percent_same[assignment], bins=20, range=(0, 100))
             ax.axvline(min(mean + 1 * std, 80), color='r')
             ax.set_xlabel('Percent Same')
             ax.set_ylabel('Number of Students')
             ax.set_title(assignment)
         else:
-            ax[x][y].hist(results[assignment][['percent_1', 'percent_2']].max(axis=1), bins=20, range=(0, 100))
+            ax[x][y].hist(percent_same[assignment], bins=20, range=(0, 100))
             ax[x][y].axvline(mean + 1 * std, color='r')
             ax[x][y].set_xlabel('Percent Same')
             ax[x][y].set_ylabel('Number of Students')
             ax[x][y].set_title(assignment)
 
     # Set title
-    fig.suptitle(class_name.parent.name)
+    fig.suptitle(data['title'])
 
     # Make everything fit
-    plt.tight_layout()
-
-    # Save plots
-    plt.savefig(plots_dir / 'histogram.png',  dpi=1000)
-
-    # Show the plot
-    # plt.show()
-    return None
+    fig.tight_layout()
+    return
 
 
-def plot_connectedness(save_dir: pathlib.Path, results: dict) -> None:
+def find_root(parents: list, node: int) -> int:
+    """
+    Union-find lookup with path halving.
+    """
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def find_clusters(pairs: pd.DataFrame) -> tuple:
+    """
+    Groups one assignment's suspicious pairs into connected components of students.
+    Pairs count when their max percent reaches min(mean + std of percent_1, 80).
+    Returns one row per component, largest first, with its density (1.0 is a clique),
+    and the flagged pairs labelled with their component.
+    """
+    columns = ['PA', 'cluster', 'size', 'pairs', 'density', 'max_percent', 'mean_percent', 'students', 'TAs']
+
+    mean = pairs['percent_1'].mean()
+    std = pairs['percent_1'].std()
+
+    # A lone pair has no std, every pair is kept then, as the loop this replaced did
+    threshold = 0 if np.isnan(mean + std) else min(mean + 1 * std, 80)
+    flagged = pairs[pairs[['percent_1', 'percent_2']].max(axis=1) >= threshold].copy()
+    flagged['percent_same'] = flagged[['percent_1', 'percent_2']].max(axis=1)
+    if len(flagged) == 0:
+        flagged['cluster'] = pd.Series(dtype=int)
+        return pd.DataFrame(columns=columns), flagged
+
+    # Number the students, then union the two sides of every flagged pair
+    codes, names = pd.factorize(pd.concat([flagged['student 1'], flagged['student 2']], ignore_index=True))
+    first, second = codes[:len(flagged)], codes[len(flagged):]
+    parents = list(range(len(names)))
+    for a, b in zip(first.tolist(), second.tolist()):
+        root_a, root_b = find_root(parents, a), find_root(parents, b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+    roots = np.array([find_root(parents, node) for node in range(len(names))])
+
+    # Each student's TA, from whichever side of a pair they were seen on
+    tas = pd.concat([flagged['TA 1'], flagged['TA 2']], ignore_index=True).groupby(codes).first().to_numpy()
+
+    clusters = list()
+    flagged['root'] = roots[first]
+    for root, edges in flagged.groupby('root'):
+        members = np.flatnonzero(roots == root)
+        size = len(members)
+        clusters.append({
+            'PA': edges['PA'].iloc[0], 'root': root, 'size': size, 'pairs': len(edges),
+            'density': min(len(edges) / max(size * (size - 1) / 2, 1), 1.0),
+            'max_percent': edges['percent_same'].max(), 'mean_percent': round(edges['percent_same'].mean(), 1),
+            'students': ', '.join(sorted(names[members])), 'TAs': ', '.join(sorted(set(tas[members])))
+        })
+
+    # Largest and strongest clusters first
+    clusters = pd.DataFrame(clusters).sort_values(['size', 'max_percent'], ascending=False, ignore_index=True)
+    clusters['cluster'] = np.arange(1, len(clusters) + 1)
+    flagged['cluster'] = flagged['root'].map(dict(zip(clusters['root'], clusters['cluster'])))
+
+    return clusters[columns], flagged.drop(columns='root')
+
+
+@timed('plot_connectedness')
+def plot_connectedness(save_dir: pathlib.Path, results: dict, preview: bool = False) -> pd.DataFrame:
     # Create sub dir for plots
     plots_dir = save_dir / 'plots'
     plots_dir.mkdir(exist_ok=True, parents=True)
 
-    # Figure parameters
-    plt.figure(figsize=(9, 9), dpi=500)
-
+    all_clusters = list()
+    tasks = list()
     for assignment in sorted(results.keys()):
-        G = nx.Graph()
-        mean = results[assignment]['percent_1'].mean()
-        std = results[assignment]['percent_1'].std()
-        for index, row in results[assignment].iterrows():
-            if max(row['percent_1'], row['percent_2']) < min(mean + 1 * std, 80):
-                continue
-            G.add_edge(row['student 1'], row['student 2'], weight=max(row['percent_1'], row['percent_2'])/300, color='r')
+        clusters, flagged = find_clusters(results[assignment])
+        all_clusters.append(clusters)
+        if len(clusters) == 0:
+            continue
 
-        edges = G.edges()
-        colors = [G[u][v]['color'] for u, v in edges]
-        nx.draw(G, with_labels=True, font_size=4, edge_color=colors)
-        plt.savefig(plots_dir / (assignment + '.png'), dpi=500)
-        plt.clf()
+        # Only the drawn clusters go to the renderer
+        drawn = flagged[flagged['cluster'] <= MAX_CLUSTER_PLOTS]
+        tasks.append(FigureTask(plots_dir / (assignment + '.png'), draw_clusters,
+                                {'assignment': assignment, 'clusters': clusters.head(MAX_CLUSTER_PLOTS),
+                                 'edges': drawn[['student 1', 'student 2', 'percent_same', 'cluster']]}, dpi=200))
 
-    return None
+    render_figures(tasks, save_dir.parent / '.saved_runs.sqlite', preview=preview)
 
+    # Save the cluster table
+    all_clusters = pd.concat(all_clusters, ignore_index=True)
+    all_clusters.to_excel(save_dir / 'clusters.xlsx', index=False)
+    print('Found {} clusters of suspicious pairs'.format(len(all_clusters)))
+
+    return all_clusters
 
-def save_to_csv(save_dir: pathlib.Path, results: dict) -> None:
-    # Check frequency by using standard deviation
-    students = dict()
-    for assignment in sorted(results.keys()):
-        mean = results[assignment][['percent_1', 'percent_2']].max(axis=1).mean()
-        std = results[assignment][['percent_1', 'percent_2']].max(axis=1).std()
-
-        for index, row in results[assignment].iterrows():
-            val_1 = (mean - row['percent_1']) / std
-            if row['student 1'] not in students:
-                students[row['student 1']] = val_1
-            else:
-                students[row['student 1']] += val_1
-
-            val_2 = (mean - row['percent_2']) / std
-            if row['student 2'] not in students:
-                students[row['student 2']] = val_2
-            else:
-                students[row['student 2']] += val_2
-
-    # Caluclate std of stds
-    vals = sorted(students.values())
-    std = statistics.pstdev(vals)
-    mean = statistics.mean(vals)
-
-    # Put in new values
-    for key in students:
-        students[key] = (students[key]-mean) / std
-
-    # Format and save to spreadsheet
-    all_data = None
-    for assignment in sorted(results.keys()):
-        # Add in additional columns for spreadsheet
-        results[assignment]['percent_same'] = results[assignment][["percent_1", "percent_2"]].max(axis=1)
-        results[assignment]['TA Confidence (1-5)'] = ''
-        results[assignment]['HEAD TA Confidence (1-5)'] = ''
-
-        # Exclude results
-        p_mean = results[assignment][['percent_1', 'percent_2']].max(axis=1).mean()
-        p_std = results[assignment][['percent_1', 'percent_2']].max(axis=1).std()
-        results[assignment] = results[assignment][(results[assignment]['percent_1'] > p_mean + 1 * p_std) |
-                                                  (results[assignment]['percent_2'] > p_mean + 1 * p_std) |
-                                                  (results[assignment]['percent_1'] > 80) |
-                                                  (results[assignment]['percent_2'] > 80) |
-                                                  (results[assignment].index < 20)]
-
-        # Add PA to total sheet
-        if all_data is None:
-            all_data = results[assignment]
-        else:
-            all_data = pd.concat([all_data, results[assignment]])
+
+def draw_clusters(fig, data: dict) -> None:
+    # Only render workers need networkx
+    import networkx as nx
+
+    clusters = data['clusters']
+
+    # One small panel per component, each with its own layout
+    fig_size = ceil(sqrt(len(clusters)))
+    fig.set_size_inches(3 * fig_size, 3 * fig_size)
+    axes = fig.subplots(nrows=fig_size, ncols=fig_size, squeeze=False)
+    for ax in axes.flat:
+        ax.axis('off')
+
+    for ax, (cluster, edges) in zip(axes.flat, data['edges'].groupby('cluster')):
+        G = nx.Graph()
+        for student_1, student_2, percent in zip(edges['student 1'], edges['student 2'], edges['percent_same']):
+            G.add_edge(student_1, student_2, weight=percent)
+        nx.draw_networkx(G, pos=nx.circular_layout(G), ax=ax, node_size=80, font_size=6, edge_color='r',
+                         width=[G[u][v]['weight'] / 30 for u, v in G.edges()])
+        ax.margins(0.3)
+        ax.set_title('Cluster {} ({:.0%} connected)'.format(cluster, clusters['density'].iloc[cluster - 1]),
+                     fontsize=8)
+        ax.axis('off')
+
+    fig.suptitle('{}: {} clusters'.format(data['assignment'], len(clusters)))
+    fig.tight_layout()
+    return
+
+
+def score_pairs(results: dict) -> tuple:
+    """
+    Flags the suspicious pairs of every assignment and scores every student, in one pass over all pairs.
+    A pair is kept when either percent is over the assignment's mean + std of pair maxima, or over 80,
+    or it is among the first 20 rows of its report. A student's score is the z-score of their summed
+    per-pair (mean - percent) / std values across the term.
+    Returns the kept pairs, in assignment then report order, and the student scores.
+    """
+    pairs = pd.concat([results[assignment] for assignment in sorted(results.keys())],
+                      keys=sorted(results.keys()))
+    pair_max = pairs[['percent_1', 'percent_2']].max(axis=1)
+
+    # Per assignment statistics of the pair maxima, broadcast back onto each pair
+    by_assignment = pair_max.groupby(level=0, sort=False)
+    mean = by_assignment.transform('mean')
+    std = by_assignment.transform('std')
+
+    # Per student totals, both sides of every pair count
+    values = pd.concat([(mean - pairs['percent_1']) / std, (mean - pairs['percent_2']) / std], ignore_index=True)
+    names = pd.concat([pairs['student 1'], pairs['student 2']], ignore_index=True)
+    totals = values.groupby(names, sort=False).sum()
+    totals[values.isna().groupby(names, sort=False).any()] = float('nan')
+    scores = (totals - totals.mean()) / totals.std(ddof=0)
+
+    # Exclude results
+    threshold = mean + 1 * std
+    kept = pairs[(pairs['percent_1'] > threshold) | (pairs['percent_2'] > threshold) |
+                 (pairs['percent_1'] > 80) | (pairs['percent_2'] > 80) |
+                 (pairs.index.get_level_values(1) < 20)].copy()
+
+    # Add in additional columns for spreadsheet
+    kept['percent_same'] = pair_max[kept.index]
+    kept['TA Confidence (1-5)'] = ''
+    kept['HEAD TA Confidence (1-5)'] = ''
+
+    return kept.droplevel(0), scores
+
+
+@timed('save_to_csv')
+def save_to_csv(save_dir: pathlib.Path, results: dict) -> pd.Series:
+    if len(results) == 0:
+        print('No results to save')
+        return pd.Series(dtype=float)
+
+    all_data, scores = score_pairs(results)
 
     # Save all data to excel
     all_data.to_excel(save_dir / (str(save_dir.parent.name) + '.xlsx'), sheet_name=save_dir.parent.name, index=False,
                       columns=['PA', 'TA 1', 'TA 2', 'student 1', 'student 2', 'percent_same',
                                'lines_matched', 'TA Confidence (1-5)', 'HEAD TA Confidence (1-5)', 'url'])
-    return
+    return scores
 
 
-def process_moss(course: pathlib.Path):
+@timed('process_moss')
+def process_moss(course: pathlib.Path, engine: str = 'moss', preview: bool = False):
     results_dir = 'plagiarism'
 
     # Create results dir if not exist
     (course / results_dir).mkdir(exist_ok=True, parents=True)
 
-    # Check and save moss results pages
-    save_websites(course / 'moss_output', course / results_dir)
+    if engine == 'local':
+        # Compare the downloaded assignments offline, no moss_output needed
+        from util.similarity import get_local_results
+        results = get_local_results(course)
+    else:
+        # Check and save moss results pages, with their match pages
+        archived = save_websites(course / 'moss_output', course / results_dir)
+
+        # Perform operations on saved results
+        results = get_results(course / results_dir)
 
-    # Perform operations on saved results
-    results = get_results(course / results_dir)
+        # Point the spreadsheet at the archived copies, MOSS deletes its pages after a few weeks
+        for assignment in results:
+            local_urls = archived.get(assignment, dict())
+            results[assignment]['url'] = results[assignment]['url'].map(lambda url: local_urls.get(url, url))
 
     # Plot histograms
-    plot_histograms(course / results_dir, results)
+    plot_histograms(course / results_dir, results, preview=preview)
 
     # Plot network graph
-    plot_connectedness(course / results_dir, results)
+    plot_connectedness(course / results_dir, results, preview=preview)
 
     # Save results to csv
     save_to_csv(course / results_dir, results)
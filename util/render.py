@@ -0,0 +1,129 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import pathlib
+
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from util.hashing import SavedRuns
+from util.metrics import get_metrics
+
+
+# Resolution used for every figure when a quick preview is asked for
+PREVIEW_DPI = 100
+
+# Workers are started once and reused by every report action of the session
+_pool = None
+
+
+class FigureTask:
+    """
+    One figure to render, a module level draw(fig, data) function, its input data and where to save it.
+    """
+
+    def __init__(self, path: pathlib.Path, draw, data: dict, dpi: int) -> None:
+        self.path = path
+        self.draw = draw
+        self.data = data
+        self.dpi = dpi
+        return
+
+
+def get_data_digest(data) -> str:
+    """
+    Stable digest of a figure's input, frames and series are hashed by value.
+    """
+    hash_blake = hashlib.blake2b(digest_size=20)
+
+    def update(value) -> None:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            labels = value.columns if isinstance(value, pd.DataFrame) else value.name
+            hash_blake.update(repr(labels).encode())
+            hash_blake.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        elif isinstance(value, dict):
+            for key in sorted(value, key=str):
+                hash_blake.update(repr(key).encode())
+                update(value[key])
+        elif isinstance(value, (list, tuple)):
+            hash_blake.update('[{}]'.format(len(value)).encode())
+            for item in value:
+                update(item)
+        else:
+            hash_blake.update(repr(value).encode())
+        return
+
+    update(data)
+    return hash_blake.hexdigest()
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for rendering, workers start fresh so no pyplot state is shared with the gui.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                    mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_worker)
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def _init_worker() -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+    return
+
+
+def render_figure(path: pathlib.Path, draw, data: dict, dpi: int) -> pathlib.Path:
+    """
+    Draws one figure on its own Figure object, no pyplot, and saves it atomically.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    draw(fig, data)
+
+    tmp_path = path.with_name('.' + path.name)
+    fig.savefig(tmp_path, dpi=dpi, format=path.suffix[1:])
+    os.replace(tmp_path, path)
+    return path
+
+
+def render_figures(tasks: list, runs_file: pathlib.Path, preview: bool = False) -> list:
+    """
+    Renders figures in parallel, skipping those whose input data and resolution match their last render.
+    Returns the paths that were rendered.
+    """
+    pending = list()
+    for task in tasks:
+        dpi = min(task.dpi, PREVIEW_DPI) if preview else task.dpi
+        saved_run = SavedRuns('render:{}'.format(task.path.resolve()), runs_file=str(runs_file))
+        saved_run.file_hash = get_data_digest({'draw': task.draw.__module__ + '.' + task.draw.__qualname__,
+                                               'data': task.data, 'dpi': dpi})
+        if task.path.is_file() and saved_run.check_hash():
+            saved_run.close()
+            continue
+        task.path.parent.mkdir(exist_ok=True, parents=True)
+        pending.append((task, dpi, saved_run))
+
+    rendered = list()
+    if len(pending) > 0:
+        executor = get_render_pool()
+        futures = [executor.submit(render_figure, task.path, task.draw, task.data, dpi) for task, dpi, _ in pending]
+        for future, (task, dpi, saved_run) in zip(futures, pending):
+            try:
+                rendered.append(future.result())
+                saved_run.save_hash()
+            except Exception as e:
+                print('Failed to render {}: {}'.format(task.path.name, e))
+            saved_run.close()
+
+    get_metrics().add('figures', len(rendered), outcome='rendered')
+    get_metrics().add('figures', len(tasks) - len(pending), outcome='unchanged')
+    print('Rendered {} figures, {} unchanged{}'.format(len(rendered), len(tasks) - len(pending),
+                                                       ' (preview)' if preview else ''))
+    return rendered
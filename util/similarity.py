@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import pathlib
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Token k-gram length and winnowing window, any shared run of K_GRAM + WINDOW - 1 tokens is always caught
+K_GRAM = 8
+WINDOW = 6
+
+# Number of pairs reported per assignment, like moss -n
+SHOW = 250
+
+C_KEYWORDS = {
+    'auto', 'break', 'case', 'char', 'const', 'continue', 'default', 'do', 'double', 'else', 'enum', 'extern',
+    'float', 'for', 'goto', 'if', 'inline', 'int', 'long', 'register', 'return', 'short', 'signed', 'sizeof',
+    'static', 'struct', 'switch', 'typedef', 'union', 'unsigned', 'void', 'volatile', 'while', 'bool', 'class',
+    'delete', 'false', 'friend', 'namespace', 'new', 'nullptr', 'operator', 'private', 'protected', 'public',
+    'template', 'this', 'throw', 'true', 'try', 'catch', 'typename', 'using', 'virtual',
+}
+
+TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\.?\d[\w.]*)
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<op>->|\+\+|--|<<=?|>>=?|[<>=!&|+\-*/%^]=|&&|\|\||::|\S)
+''', re.S | re.X)
+
+
+def tokenize(source: str) -> tuple:
+    """
+    Splits C/C++ source into normalized token ids and the line each token starts on.
+    Comments are dropped, identifiers, numbers and string literals each collapse to one token,
+    so renaming variables or changing constants does not hide a match.
+    """
+    tokens = list()
+    offsets = list()
+    for match in TOKEN_PATTERN.finditer(source):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        if kind == 'word':
+            text = match.group() if match.group() in C_KEYWORDS else 'V'
+        elif kind == 'number':
+            text = 'N'
+        elif kind == 'string':
+            text = 'S'
+        else:
+            text = match.group()
+        tokens.append(zlib.crc32(text.encode()))
+        offsets.append(match.start())
+
+    # Line of each token from the newline offsets
+    newlines = np.array([m.start() for m in re.finditer('\n', source)], dtype=np.int64)
+    lines = np.searchsorted(newlines, np.array(offsets, dtype=np.int64)) + 1
+
+    return np.array(tokens, dtype=np.uint64), lines
+
+
+def fingerprint(tokens: np.ndarray, k: int = K_GRAM, window: int = WINDOW) -> tuple:
+    """
+    Winnows the k-gram hashes of a token stream, returns the selected hashes and their token positions.
+    """
+    if len(tokens) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+
+    # Polynomial hash of every k-gram, uint64 arithmetic wraps around
+    powers = np.uint64(1000003) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    grams = np.lib.stride_tricks.sliding_window_view(tokens, k)
+    hashes = (grams * powers).sum(axis=1, dtype=np.uint64)
+
+    if len(hashes) < window:
+        return hashes[[hashes.argmin()]], np.array([hashes.argmin()], dtype=np.int64)
+
+    # Rightmost minimum of every window, each position is kept once
+    windows = np.lib.stride_tricks.sliding_window_view(hashes, window)
+    rightmost = window - 1 - windows[:, ::-1].argmin(axis=1)
+    positions = np.unique(np.arange(len(windows)) + rightmost)
+
+    return hashes[positions], positions
+
+
+def fingerprint_student(student_dir: pathlib.Path, k: int = K_GRAM, window: int = WINDOW) -> tuple:
+    """
+    Fingerprints every file of a student, returns the hashes and the (file, line) each starts on.
+    """
+    all_hashes = list()
+    all_lines = list()
+    for file_ind, file_path in enumerate(sorted(student_dir.iterdir())):
+        if not file_path.is_file():
+            continue
+        tokens, lines = tokenize(file_path.read_text(encoding='utf-8', errors='replace'))
+        hashes, positions = fingerprint(tokens, k, window)
+        all_hashes.append(hashes)
+        all_lines.append(file_ind * 10 ** 7 + lines[positions])
+
+    if len(all_hashes) == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    return np.concatenate(all_hashes), np.concatenate(all_lines)
+
+
+# Fingerprint sets shared with the comparison workers
+_shared = dict()
+
+
+def _init_worker(unique_hashes: list) -> None:
+    _shared['unique'] = unique_hashes
+    _shared['all'] = np.concatenate(unique_hashes)
+    _shared['owner'] = np.repeat(np.arange(len(unique_hashes)), [len(h) for h in unique_hashes])
+    return
+
+
+def _compare_student(i: int) -> np.ndarray:
+    """
+    Counts the distinct fingerprints student i shares with every later student.
+    """
+    shared = np.isin(_shared['all'], _shared['unique'][i], assume_unique=False)
+    counts = np.bincount(_shared['owner'][shared], minlength=len(_shared['unique']))
+    counts[:i + 1] = 0
+    return counts
+
+
+def compare_assignment(assignment_dir: pathlib.Path, k: int = K_GRAM, window: int = WINDOW,
+                       show: int = SHOW, workers: int = None) -> pd.DataFrame:
+    """
+    Compares every pair of students in an assignment, in the same record format process.get_results uses.
+    """
+    columns = ['PA', 'TA 1', 'TA 2', 'student 1', 'student 2', 'percent_1', 'percent_2', 'lines_matched', 'url']
+    students = sorted(path for path in assignment_dir.glob('*/*') if path.is_dir())
+    if len(students) < 2:
+        return pd.DataFrame(columns=columns)
+
+    fingerprints = [fingerprint_student(student, k, window) for student in students]
+    unique_hashes = [np.unique(hashes) for hashes, _ in fingerprints]
+
+    # Pairwise stage, one task per student spread over processes
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(unique_hashes,)) as executor:
+        shared_counts = np.array(list(executor.map(_compare_student, range(len(students)), chunksize=16)))
+
+    sizes = np.array([max(len(h), 1) for h in unique_hashes])
+    first, second = np.nonzero(shared_counts)
+    shared = shared_counts[first, second]
+    percent_1 = (100 * shared / sizes[first]).astype(int)
+    percent_2 = (100 * shared / sizes[second]).astype(int)
+
+    # Report the strongest pairs first, like the moss results table
+    order = np.lexsort((-shared, -np.maximum(percent_1, percent_2)))[:show]
+
+    records = list()
+    for ind in order:
+        i, j = first[ind], second[ind]
+        common = np.intersect1d(unique_hashes[i], unique_hashes[j])
+        hashes, lines = fingerprints[i]
+        records.append({
+            'PA': assignment_dir.name,
+            'TA 1': students[i].parent.name, 'TA 2': students[j].parent.name,
+            'student 1': students[i].name, 'student 2': students[j].name,
+            'percent_1': int(percent_1[ind]), 'percent_2': int(percent_2[ind]),
+            'lines_matched': len(np.unique(lines[np.isin(hashes, common)])), 'url': ''
+        })
+
+    return pd.DataFrame(records, columns=columns)
+
+
+def get_local_results(course_dir: pathlib.Path, assignments_list: list = None, **kwargs) -> dict:
+    """
+    Offline replacement for running moss and process.get_results on the downloaded assignments.
+    """
+    results = dict()
+    for assignment_dir in sorted((course_dir / 'assignments').iterdir()):
+        if not assignment_dir.is_dir():
+            continue
+        if assignments_list is not None and assignment_dir.name not in assignments_list:
+            continue
+        print('Comparing:', assignment_dir.name)
+        results[assignment_dir.name] = compare_assignment(assignment_dir, **kwargs)
+    return results
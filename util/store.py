@@ -0,0 +1,39 @@
+import pathlib
+import pandas as pd
+
+
+# Directory inside a course dir holding the binary copies of its spreadsheets
+STORE_DIR = '.store'
+
+
+def save_frame(course_dir: pathlib.Path, name: str, frame: pd.DataFrame) -> None:
+    """
+    Saves frame as course_dir / name.xlsx for people and as a Feather copy for the pipeline.
+    """
+    frame.to_excel(course_dir / (name + '.xlsx'))
+
+    store_dir = course_dir / STORE_DIR
+    store_dir.mkdir(exist_ok=True, parents=True)
+    store_path = store_dir / (name + '.feather')
+
+    try:
+        frame.reset_index(drop=True).to_feather(store_path)
+    except (ValueError, TypeError) as e:
+        # Columns arrow cannot type, readers fall back on the spreadsheet
+        print(f"Could not store {name} in columnar format: {e}")
+        store_path.unlink(missing_ok=True)
+    return
+
+
+def load_frame(course_dir: pathlib.Path, name: str) -> pd.DataFrame:
+    """
+    Loads a frame saved with save_frame, preferring the Feather copy unless the spreadsheet is newer.
+    """
+    excel_path = course_dir / (name + '.xlsx')
+    store_path = course_dir / STORE_DIR / (name + '.feather')
+
+    if store_path.is_file() and (not excel_path.is_file() or
+                                 store_path.stat().st_mtime_ns >= excel_path.stat().st_mtime_ns):
+        return pd.read_feather(store_path)
+
+    return pd.read_excel(excel_path)